@@ -1,18 +1,46 @@
-from flask import Flask, jsonify, request, send_from_directory, redirect, url_for, session, render_template_string
+from flask import Flask, jsonify, request, send_from_directory, redirect, url_for, session, render_template_string, Response, stream_with_context
 from flask_cors import CORS
 import os
 import json
 import time
 import uuid
 import threading
+import heapq
+import bisect
+from array import array
+import math
+import copy
+import tempfile
+import base64
+import sqlite3
+import itertools
+import hashlib
+import zlib
+import unicodedata
+import dataclasses
+from dataclasses import dataclass
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError, as_completed
 import secrets
 from functools import wraps
 import openai
 import re
 import requests
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 import urllib.parse
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# 向量检索依赖numpy，未安装时只能使用关键词检索
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 # 创建Flask应用
 app = Flask(__name__, static_folder='static')
 app.secret_key = secrets.token_hex(16)  # 为session设置密钥
@@ -26,33 +54,149 @@ DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
 CASES_DIR = os.path.join(DATA_DIR, 'cases')
 TAGS_FILE = os.path.join(DATA_DIR, 'tags.json')
 SETTINGS_FILE = os.path.join(DATA_DIR, 'settings.json')
+SEARCH_CACHE_FILE = os.path.join(DATA_DIR, 'search_cache.json')
+CASES_DB_FILE = os.path.join(DATA_DIR, 'cases.db')
+CASE_EMBEDDINGS_FILE = os.path.join(DATA_DIR, 'case_embeddings.npz')
+CONVERSATIONS_DIR = os.path.join(DATA_DIR, 'conversations')
+
+# 案例存储后端：json（每个案例一个JSON文件）或 sqlite（data/cases.db，带FTS5全文索引）
+CASE_STORAGE = os.environ.get('CASE_STORAGE', 'json')
 
 # 确保数据目录存在
 os.makedirs(CASES_DIR, exist_ok=True)
 os.makedirs(DATA_DIR, exist_ok=True)
+os.makedirs(CONVERSATIONS_DIR, exist_ok=True)
+
+# 进程内的路径锁（同一进程的线程之间互斥）
+_path_locks = {}
+_path_locks_guard = threading.Lock()
+
+def _path_lock(path):
+    with _path_locks_guard:
+        return _path_locks.setdefault(path, threading.Lock())
+
+# 跨进程文件锁：先获取进程内锁，再对 <path>.lock 加flock排他锁
+# 没有fcntl的平台（Windows）只做进程内互斥
+@contextmanager
+def file_lock(path):
+    with _path_lock(path):
+        if fcntl is None:
+            yield
+            return
+        with open(f"{path}.lock", 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+# 原子写入JSON：写入同目录下的临时文件并fsync，再rename替换目标文件
+# 读取方要么看到旧文件，要么看到完整的新文件，不会读到写了一半的JSON
+def atomic_write_json(path, data):
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.", suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+    if hasattr(os, 'O_DIRECTORY'):
+        dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+# JSON文档：读取返回内存中的快照（只读），按mtime发现其他进程的修改；
+# 写入在文件锁内基于磁盘上的最新内容修改副本，原子写入后整体替换快照
+class JsonDocument:
+    def __init__(self, path, refresh_interval=2.0):
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._data = None
+        self._mtime = None
+        self._last_check = 0.0
+
+    def _file_mtime(self):
+        try:
+            stat = os.stat(self.path)
+            return (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            return None
+
+    def _load(self):
+        mtime = self._file_mtime()
+        with open(self.path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        self._data = data
+        self._mtime = mtime
+        return data
+
+    def read(self):
+        data = self._data
+        if data is not None and time.time() - self._last_check < self.refresh_interval:
+            return data
+        with self._lock:
+            self._last_check = time.time()
+            if self._data is None or self._file_mtime() != self._mtime:
+                self._load()
+            return self._data
+
+    # 读取-修改-写入：modify接收数据副本并就地修改
+    def update(self, modify):
+        with file_lock(self.path):
+            with self._lock:
+                data = copy.deepcopy(self._load())
+                modify(data)
+                atomic_write_json(self.path, data)
+                self._data = data
+                self._mtime = self._file_mtime()
+                self._last_check = time.time()
+                return data
+
+    def write(self, data):
+        with file_lock(self.path):
+            with self._lock:
+                atomic_write_json(self.path, data)
+                self._data = data
+                self._mtime = self._file_mtime()
+                self._last_check = time.time()
+                return data
 
 # 初始化数据文件
 if not os.path.exists(TAGS_FILE):
-    with open(TAGS_FILE, 'w') as f:
-        json.dump({"categories": {
-            "行业": ["制造业", "金融业", "互联网", "零售业", "医疗健康"],
-            "规模": ["大型企业", "中型企业", "小型企业", "创业公司"],
-            "主题": ["战略规划", "组织变革", "流程优化", "数字化转型", "人才管理"]
-        }}, f)
+    atomic_write_json(TAGS_FILE, {"categories": {
+        "行业": ["制造业", "金融业", "互联网", "零售业", "医疗健康"],
+        "规模": ["大型企业", "中型企业", "小型企业", "创业公司"],
+        "主题": ["战略规划", "组织变革", "流程优化", "数字化转型", "人才管理"]
+    }})
+
+# 默认设置
+DEFAULT_SETTINGS = {
+    "company": {
+        "name": "写春秋企业管理咨询",
+        "description": "专注于企业战略规划与管理咨询的专业服务机构"
+    },
+    "ai": {
+        "provider": "deepseek",
+        "api_key": "",
+        "temperature": 0.7
+    }
+}
 
 if not os.path.exists(SETTINGS_FILE):
-    with open(SETTINGS_FILE, 'w') as f:
-        json.dump({
-            "company": {
-                "name": "写春秋企业管理咨询",
-                "description": "专注于企业战略规划与管理咨询的专业服务机构"
-            },
-            "ai": {
-                "provider": "deepseek",
-                "api_key": "",
-                "temperature": 0.7
-            }
-        }, f)
+    atomic_write_json(SETTINGS_FILE, DEFAULT_SETTINGS)
+
+# 标签库
+tags_document = JsonDocument(TAGS_FILE)
 
 # 登录页面HTML模板
 LOGIN_HTML = """
@@ -144,76 +288,1474 @@ def password_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
-# 加载所有案例详细内容
-def load_all_cases():
-    cases = []
-    if os.path.exists(CASES_DIR):
-        for filename in os.listdir(CASES_DIR):
-            if filename.endswith('.json'):
-                try:
-                    with open(os.path.join(CASES_DIR, filename), 'r', encoding='utf-8') as f:
-                        case = json.load(f)
-                        cases.append(case)
-                except Exception as e:
-                    print(f"加载案例文件 {filename} 时出错: {str(e)}")
-    return cases
-
-# 根据关键词匹配相关案例
-def find_relevant_cases(message, cases, max_cases=3):
-    if not cases:
+# 设置格式错误
+class SettingsError(ValueError):
+    pass
+
+# 校验后的应用设置（不可变），raw保留原始设置数据供设置页面使用
+@dataclass(frozen=True)
+class Settings:
+    company_name: str
+    company_description: str
+    ai_provider: str
+    api_key: str
+    temperature: float
+    raw: dict = dataclasses.field(hash=False, compare=False, repr=False)
+
+    @classmethod
+    def from_dict(cls, data):
+        if not isinstance(data, dict):
+            raise SettingsError("设置必须是JSON对象")
+        company = data.get('company') or {}
+        ai = data.get('ai') or {}
+        if not isinstance(company, dict) or not isinstance(ai, dict):
+            raise SettingsError("company和ai设置必须是JSON对象")
+
+        api_key = ai.get('api_key') or ''
+        if not isinstance(api_key, str):
+            raise SettingsError("api_key必须是字符串")
+
+        try:
+            temperature = float(ai.get('temperature', DEFAULT_SETTINGS['ai']['temperature']))
+        except (TypeError, ValueError):
+            raise SettingsError("temperature必须是数字")
+        if not 0 <= temperature <= 2:
+            raise SettingsError("temperature必须在0到2之间")
+
+        return cls(
+            company_name=str(company.get('name') or DEFAULT_SETTINGS['company']['name']),
+            company_description=str(company.get('description') or ''),
+            ai_provider=str(ai.get('provider') or DEFAULT_SETTINGS['ai']['provider']),
+            api_key=api_key.strip(),
+            temperature=temperature,
+            raw=data
+        )
+
+# 设置服务：在内存中保存校验后的设置对象，按文件mtime发现其他worker的修改
+class SettingsService:
+    def __init__(self, settings_file, refresh_interval=2.0):
+        self.settings_file = settings_file
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._settings = None
+        self._mtime = None
+        self._last_check = 0.0
+
+    def _file_mtime(self):
+        try:
+            stat = os.stat(self.settings_file)
+            return (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            return None
+
+    def _load(self):
+        mtime = self._file_mtime()
+        try:
+            with open(self.settings_file, 'r', encoding='utf-8') as f:
+                settings = Settings.from_dict(json.load(f))
+        except Exception as e:
+            print(f"加载设置文件时出错: {str(e)}")
+            if self._settings is not None:
+                return
+            settings = Settings.from_dict(DEFAULT_SETTINGS)
+        self._settings = settings
+        self._mtime = mtime
+
+    # 获取当前设置：热路径直接返回内存中的对象，每隔refresh_interval秒才检查一次文件
+    def get(self):
+        settings = self._settings
+        if settings is not None and time.time() - self._last_check < self.refresh_interval:
+            return settings
+        with self._lock:
+            self._last_check = time.time()
+            if self._settings is None or self._file_mtime() != self._mtime:
+                self._load()
+            return self._settings
+
+    # 校验并保存新设置，成功后整体替换内存中的设置对象
+    def update(self, data):
+        settings = Settings.from_dict(data)
+        with file_lock(self.settings_file), self._lock:
+            atomic_write_json(self.settings_file, data)
+            self._settings = settings
+            self._mtime = self._file_mtime()
+            self._last_check = time.time()
+        return settings
+
+# 全局设置服务
+settings_service = SettingsService(SETTINGS_FILE)
+
+# 案例列表分页：默认每页条数和最大条数
+CASE_PAGE_SIZE = 50
+CASE_PAGE_MAX = 200
+
+# 案例列表排序键：按创建时间倒序，同一时间按ID倒序
+def case_sort_key(case):
+    return (str(case.get('created_at') or ''), str(case.get('id') or ''))
+
+# 判断案例是否满足列表筛选条件（标签完全匹配，关键词匹配标题或描述，创建日期范围）
+def case_matches_filters(case, tag=None, query=None, created_from=None, created_to=None):
+    if tag and tag not in (case.get('tags') or []):
+        return False
+    if query:
+        text = f"{case.get('title') or ''}\n{case.get('description') or ''}".lower()
+        if query.lower() not in text:
+            return False
+    created_at = str(case.get('created_at') or '')
+    if created_from and created_at < created_from:
+        return False
+    if created_to and created_at[:len(created_to)] > created_to:
+        return False
+    return True
+
+# 分页游标：对排序键做base64编码
+def encode_case_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode('utf-8')).decode('ascii')
+
+def decode_case_cursor(cursor):
+    try:
+        created_at, case_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except Exception:
+        raise ValueError("无效的分页游标")
+    return (str(created_at), str(case_id))
+
+# 案例仓库：进程内缓存所有案例，按文件mtime增量刷新
+# 其他gunicorn worker或手工修改的案例文件会在下一次刷新时被发现
+class CaseStore:
+    def __init__(self, cases_dir, refresh_interval=2.0):
+        self.cases_dir = cases_dir
+        self.refresh_interval = refresh_interval
+        self._lock = threading.RLock()
+        self._write_lock = threading.RLock()  # 保存、删除和快照互斥；读取和刷新只用_lock
+        self._cases = {}   # case_id -> 案例数据
+        self._mtimes = {}  # case_id -> (文件mtime, 文件大小)
+        self._loaded = False
+        self._last_check = 0.0
+        self._frozen = False
+        self._listeners = []
+
+    # 订阅案例变更，回调参数为 (case_id, case)，删除时 case 为 None
+    # replay为True时先把已加载的案例逐个通知给新订阅者；只关心后续变更的订阅者（如缓存失效）传False
+    def subscribe(self, listener, replay=True):
+        with self._lock:
+            self._listeners.append(listener)
+            if replay:
+                for case_id, case in self._cases.items():
+                    listener(case_id, case)
+
+    def _notify(self, case_id, case):
+        for listener in self._listeners:
+            try:
+                listener(case_id, case)
+            except Exception as e:
+                print(f"案例变更通知 {case_id} 时出错: {str(e)}")
+
+    def _case_file(self, case_id):
+        return os.path.join(self.cases_dir, f"{case_id}.json")
+
+    # 快照期间持有写锁：本进程的保存和删除等待快照结束，也不再扫描目录，期间的检索都基于同一份案例
+    # 读取不受影响，刷新在冻结时直接返回
+    @contextmanager
+    def snapshot(self):
+        with self._write_lock:
+            self.refresh(force=True)
+            self._frozen = True
+            try:
+                yield
+            finally:
+                self._frozen = False
+
+    # 扫描案例目录，只重新解析新增或mtime变化的文件
+    def refresh(self, force=False):
+        now = time.time()
+        # 先不加锁检查，快照期间或刷新间隔内的调用不必等待锁
+        if self._frozen or (not force and self._loaded and now - self._last_check < self.refresh_interval):
+            return
+        with self._lock:
+            if self._frozen or (not force and self._loaded and now - self._last_check < self.refresh_interval):
+                return
+            self._last_check = now
+            self._loaded = True
+
+            seen = set()
+            if os.path.exists(self.cases_dir):
+                for entry in os.scandir(self.cases_dir):
+                    if not entry.name.endswith('.json'):
+                        continue
+                    case_id = entry.name[:-len('.json')]
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    seen.add(case_id)
+                    mtime = (stat.st_mtime_ns, stat.st_size)
+                    if self._mtimes.get(case_id) == mtime:
+                        continue
+                    try:
+                        with open(entry.path, 'r', encoding='utf-8') as f:
+                            case = json.load(f)
+                    except Exception as e:
+                        print(f"加载案例文件 {entry.name} 时出错: {str(e)}")
+                        continue
+                    self._cases[case_id] = case
+                    self._mtimes[case_id] = mtime
+                    self._notify(case_id, case)
+
+            for case_id in list(self._cases):
+                if case_id not in seen:
+                    del self._cases[case_id]
+                    self._mtimes.pop(case_id, None)
+                    self._notify(case_id, None)
+
+    def all(self):
+        self.refresh()
+        with self._lock:
+            return list(self._cases.values())
+
+    def get(self, case_id):
+        self.refresh()
+        with self._lock:
+            return self._cases.get(case_id)
+
+    # 按案例库顺序返回前n个案例
+    def head(self, n):
+        self.refresh()
+        with self._lock:
+            return list(itertools.islice(self._cases.values(), n))
+
+    def count(self):
+        self.refresh()
+        with self._lock:
+            return len(self._cases)
+
+    # 筛选并分页，after为上一页最后一个案例的排序键；返回 (本页案例, 下一页游标键, 总数)
+    def list_cases(self, tag=None, query=None, created_from=None, created_to=None, after=None, limit=CASE_PAGE_SIZE):
+        self.refresh()
+        with self._lock:
+            cases = list(self._cases.values())
+        matched = [case for case in cases if case_matches_filters(case, tag, query, created_from, created_to)]
+        total = len(matched)
+        if after is not None:
+            matched = [case for case in matched if case_sort_key(case) < after]
+        page = heapq.nlargest(limit + 1, matched, key=case_sort_key)
+        next_key = case_sort_key(page[limit - 1]) if len(page) > limit else None
+        return page[:limit], next_key, total
+
+    # 写穿：先写文件，再更新内存中的案例
+    def save(self, case_id, case):
+        case_file = self._case_file(case_id)
+        with file_lock(self.cases_dir), self._write_lock, self._lock:
+            atomic_write_json(case_file, case)
+            self._cases[case_id] = case
+            stat = os.stat(case_file)
+            self._mtimes[case_id] = (stat.st_mtime_ns, stat.st_size)
+            self._notify(case_id, case)
+        return case
+
+    def delete(self, case_id):
+        case_file = self._case_file(case_id)
+        with file_lock(self.cases_dir), self._write_lock, self._lock:
+            existed = os.path.exists(case_file)
+            if existed:
+                os.remove(case_file)
+            if self._cases.pop(case_id, None) is not None:
+                self._notify(case_id, None)
+            self._mtimes.pop(case_id, None)
+            return existed
+
+# 案例字段、字段命中位及其相关性权重（标签单独按完全匹配计分）
+# 权重同时作为BM25F的字段加权
+RELEVANCE_FIELDS = [('title', 1, 3), ('description', 2, 2), ('content', 4, 1)]
+TAG_WEIGHT = 3
+
+# 行业关键词
+INDUSTRY_KEYWORDS = ["制造业", "金融业", "互联网", "零售业", "医疗健康", "教育", "物流", "能源", "房地产"]
+
+# 企业规模关键词
+SIZE_KEYWORDS = ["大型企业", "中型企业", "小型企业", "创业公司", "跨国公司", "国企", "民营企业"]
+
+# 管理主题关键词
+TOPIC_KEYWORDS = [
+    "战略规划", "组织变革", "流程优化", "数字化转型", "人才管理", "绩效管理", "企业文化",
+    "领导力", "创新", "市场营销", "供应链", "财务管理", "风险管理", "质量管理",
+    "成本控制", "客户关系", "并购", "国际化", "产品开发", "技术创新"
+]
+
+BUILTIN_KEYWORDS = INDUSTRY_KEYWORDS + SIZE_KEYWORDS + TOPIC_KEYWORDS
+
+# BM25F参数：k1控制词频饱和，b控制各字段的长度归一化程度
+BM25_K1 = 1.2
+BM25_B = {'title': 0.75, 'description': 0.75, 'content': 0.75, 'tags': 0.0}
+
+# 将文本切分为字符n-gram（单字+双字），用于中文子串检索
+def char_ngrams(text):
+    grams = set(text)
+    for i in range(len(text) - 1):
+        grams.add(text[i:i+2])
+    return grams
+
+# 关键词对应的检索n-gram：双字词及以上只需双字gram即可覆盖
+def keyword_ngrams(keyword):
+    if len(keyword) < 2:
+        return {keyword}
+    return {keyword[i:i+2] for i in range(len(keyword) - 1)}
+
+# 倒排索引的gram桶数：gram按哈希值分桶，不同gram共用同一个posting，内存只随案例数和内容长度增长
+CASE_INDEX_BUCKETS = 1 << 16
+
+# 案例倒排索引：gram所在的桶 -> 命中的案例及字段位，随案例仓库增量更新
+# 分桶会带来少量误报候选，计分时按字段原文核实词频，结果与逐个gram建索引一致
+class CaseIndex:
+    def __init__(self):
+        self._lock = threading.RLock()
+        # 桶号 -> 按文档号排序的array('I')，每项为 文档号<<3 | 字段位
+        self._postings = {}
+        self._tags = {}      # tag -> {case_id}
+        self._docs = {}      # case_id -> (case, tags)；删除时从case重新计算gram
+        self._order = {}     # case_id -> 文档号（插入序号），同分时保持案例库顺序
+        self._ids = {}       # 文档号 -> case_id
+        self._seq = 0
+        self._lengths = {}   # case_id -> {字段: 长度}
+        self._total_lengths = {field: 0 for field in BM25_B}
+        self._df_cache = {}  # keyword -> 包含该关键词的案例数
+
+    def on_case_changed(self, case_id, case):
+        if case is None:
+            self.remove(case_id)
+        else:
+            self.update(case_id, case)
+
+    # 案例各字段的gram所在的桶及其字段命中位 {桶号: 字段位}
+    @staticmethod
+    def _case_buckets(case):
+        buckets = {}
+        for field, bit, _ in RELEVANCE_FIELDS:
+            for gram in char_ngrams(str(case.get(field) or '')):
+                bucket = hash(gram) % CASE_INDEX_BUCKETS
+                buckets[bucket] = buckets.get(bucket, 0) | bit
+        return buckets
+
+    def update(self, case_id, case):
+        buckets = self._case_buckets(case)
+        tags = set(t for t in (case.get('tags') or []) if isinstance(t, str))
+        lengths = {field: len(str(case.get(field) or '')) for field, _, _ in RELEVANCE_FIELDS}
+        lengths['tags'] = len(tags)
+
+        with self._lock:
+            self._remove_postings(case_id)
+            docno = self._order.get(case_id)
+            if docno is None:
+                self._seq += 1
+                docno = self._order[case_id] = self._seq
+                self._ids[docno] = case_id
+            for bucket, bits in buckets.items():
+                posting = self._postings.get(bucket)
+                if posting is None:
+                    self._postings[bucket] = array('I', (docno << 3 | bits,))
+                elif posting[-1] >> 3 < docno:
+                    posting.append(docno << 3 | bits)
+                else:
+                    bisect.insort(posting, docno << 3 | bits)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(case_id)
+            self._docs[case_id] = (case, tags)
+            self._lengths[case_id] = lengths
+            for field, length in lengths.items():
+                self._total_lengths[field] += length
+            self._df_cache.clear()
+
+    def remove(self, case_id):
+        with self._lock:
+            self._remove_postings(case_id)
+            docno = self._order.pop(case_id, None)
+            self._ids.pop(docno, None)
+
+    def _remove_postings(self, case_id):
+        doc = self._docs.pop(case_id, None)
+        if doc is None:
+            return
+        for field, length in self._lengths.pop(case_id).items():
+            self._total_lengths[field] -= length
+        self._df_cache.clear()
+        case, tags = doc
+        docno = self._order[case_id]
+        for bucket in self._case_buckets(case):
+            posting = self._postings.get(bucket)
+            if posting is None:
+                continue
+            i = bisect.bisect_left(posting, docno << 3)
+            if i < len(posting) and posting[i] >> 3 == docno:
+                del posting[i]
+                if not posting:
+                    del self._postings[bucket]
+        for tag in tags:
+            ids = self._tags.get(tag)
+            if ids is not None:
+                ids.discard(case_id)
+                if not ids:
+                    del self._tags[tag]
+
+    # 返回关键词的候选案例：{case_id: 所有gram共同命中的字段位}
+    # 从最短的posting出发，在其余posting中二分查找同一文档号
+    def _candidates(self, keyword):
+        postings = []
+        for gram in keyword_ngrams(keyword):
+            posting = self._postings.get(hash(gram) % CASE_INDEX_BUCKETS)
+            if not posting:
+                return {}
+            postings.append(posting)
+        postings.sort(key=len)
+
+        candidates = {entry >> 3: entry & 7 for entry in postings[0]}
+        for posting in postings[1:]:
+            for docno in list(candidates):
+                i = bisect.bisect_left(posting, docno << 3)
+                bits = candidates[docno] & posting[i] if i < len(posting) and posting[i] >> 3 == docno else 0
+                if bits:
+                    candidates[docno] = bits
+                else:
+                    del candidates[docno]
+        return {self._ids[docno]: bits for docno, bits in candidates.items()}
+
+    # 可能包含关键词（任一字段含有其全部gram）或以其为标签的案例ID，需由调用方逐个核实
+    def candidate_ids(self, keyword):
+        with self._lock:
+            return set(self._candidates(keyword)) | self._tags.get(keyword, set())
+
+    # 关键词在各命中案例中的加权词频（BM25F的字段加权与长度归一化）
+    def _weighted_tf(self, keyword, avg_lengths):
+        matches = {}
+        for case_id, bits in self._candidates(keyword).items():
+            case = self._docs[case_id][0]
+            lengths = self._lengths[case_id]
+            for field, bit, weight in RELEVANCE_FIELDS:
+                if not bits & bit:
+                    continue
+                tf = str(case.get(field) or '').count(keyword)
+                if tf:
+                    b = BM25_B[field]
+                    norm = 1 - b + b * lengths[field] / avg_lengths[field]
+                    matches[case_id] = matches.get(case_id, 0.0) + weight * tf / norm
+        for case_id in self._tags.get(keyword, ()):
+            b = BM25_B['tags']
+            norm = 1 - b + b * self._lengths[case_id]['tags'] / avg_lengths['tags']
+            matches[case_id] = matches.get(case_id, 0.0) + TAG_WEIGHT / norm
+        return matches
+
+    # BM25F评分：标题3/描述2/内容1/标签3作为字段加权，结合词频、文档长度和逆文档频率
+    def score(self, keywords):
+        scores = {}
+        with self._lock:
+            total = len(self._docs)
+            if not total:
+                return scores
+            avg_lengths = {field: (length / total) or 1.0 for field, length in self._total_lengths.items()}
+
+            for keyword in dict.fromkeys(keywords):
+                if not keyword:
+                    continue
+                matches = self._weighted_tf(keyword, avg_lengths)
+                df = self._df_cache.setdefault(keyword, len(matches))
+                idf = math.log(1 + (total - df + 0.5) / (df + 0.5))
+                for case_id, tf in matches.items():
+                    scores[case_id] = scores.get(case_id, 0.0) + idf * tf * (BM25_K1 + 1) / (BM25_K1 + tf)
+        return scores
+
+    def top(self, keywords, max_cases):
+        scores = self.score(keywords)
+        with self._lock:
+            ranked = heapq.nsmallest(
+                max_cases, scores.items(),
+                key=lambda item: (-item[1], self._order.get(item[0], 0))
+            )
+            return [(self._docs[case_id][0], score) for case_id, score in ranked]
+
+# 段落切分参数：每段最多PASSAGE_SIZE个字符，相邻段落重叠约PASSAGE_OVERLAP个字符，尽量在句末断开
+PASSAGE_SIZE = int(os.environ.get('PASSAGE_SIZE', '300'))
+PASSAGE_OVERLAP = 60
+# 每个案例最多送入提示词的段落数
+PASSAGES_PER_CASE = 3
+PASSAGE_BREAKS = '。！？；\n!?;'
+
+# 将文本切分为相互重叠的段落，返回 [(起始位置, 结束位置)]
+def chunk_text(text, size=PASSAGE_SIZE, overlap=PASSAGE_OVERLAP):
+    if not text:
         return []
-    
-    # 提取关键词
-    keywords = extract_keywords(message)
-    
-    # 计算每个案例的相关性得分
-    scored_cases = []
+    spans = []
+    start = 0
+    while True:
+        end = min(start + size, len(text))
+        if end < len(text):
+            # 在窗口后半段找最后一个句末标点断开
+            cut = max(text.rfind(ch, start + size // 2, end) for ch in PASSAGE_BREAKS)
+            if cut >= 0:
+                end = cut + 1
+        spans.append((start, end))
+        if end >= len(text):
+            return spans
+        # 下一段从重叠区内的第一个句子开头开始，找不到句末时直接回退overlap个字符
+        next_start = max(end - overlap, start + 1)
+        cut = min((i for i in (text.find(ch, next_start, end - 1) for ch in PASSAGE_BREAKS) if i >= 0), default=-1)
+        start = cut + 1 if cut >= 0 else next_start
+
+# 为检索到的案例选出最相关的段落，返回 {case_id: [(起始位置, 结束位置, 得分)]}，每个案例最多limit个段落
+# 只切分传入的几个案例，段落的BM25统计量（平均长度、IDF）来自这些案例的段落，不需要全库的段落索引
+def top_case_passages(cases, keywords, limit=PASSAGES_PER_CASE):
+    passages = []  # (case_id, 段落序号, 起始位置, 结束位置, 详细内容)
     for case in cases:
-        score = calculate_relevance_score(case, keywords)
-        scored_cases.append((case, score))
+        content = str(case.get('content') or '')
+        for n, (start, end) in enumerate(chunk_text(content)):
+            passages.append((case.get('id'), n, start, end, content))
+    if not passages:
+        return {}
     
-    # 按相关性得分排序并返回前N个案例
-    scored_cases.sort(key=lambda x: x[1], reverse=True)
-    return [case for case, score in scored_cases[:max_cases]]
-
-# 提取关键词
-def extract_keywords(message):
-    # 行业关键词
-    industry_keywords = ["制造业", "金融业", "互联网", "零售业", "医疗健康", "教育", "物流", "能源", "房地产"]
+    avg_length = sum(end - start for _, _, start, end, _ in passages) / len(passages)
+    scores = {}
+    for keyword in dict.fromkeys(k for k in keywords if k):
+        hits = []
+        for i, (case_id, n, start, end, content) in enumerate(passages):
+            tf = content.count(keyword, start, end)
+            if tf:
+                hits.append((i, tf))
+        if not hits:
+            continue
+        idf = math.log(1 + (len(passages) - len(hits) + 0.5) / (len(hits) + 0.5))
+        for i, tf in hits:
+            start, end = passages[i][2], passages[i][3]
+            norm = 1 - BM25_B['content'] + BM25_B['content'] * (end - start) / avg_length
+            scores[i] = scores.get(i, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * norm)
     
-    # 企业规模关键词
-    size_keywords = ["大型企业", "中型企业", "小型企业", "创业公司", "跨国公司", "国企", "民营企业"]
+    ranked = {}
+    for i, score in sorted(scores.items(), key=lambda item: (-item[1], passages[item[0]][1])):
+        case_id, n, start, end, _ = passages[i]
+        case_passages = ranked.setdefault(case_id, [])
+        if len(case_passages) < limit:
+            case_passages.append((start, end, score))
+    return ranked
+
+# 将文本转换为空格分隔的双字gram，写入FTS5后可用短语查询实现中文子串匹配
+def fts_ngram_text(text):
+    if len(text) < 2:
+        return text
+    return ' '.join(text[i:i+2] for i in range(len(text) - 1))
+
+# 关键词对应的FTS5短语查询
+def fts_phrase(keyword):
+    return '"' + fts_ngram_text(keyword).replace('"', '""') + '"'
+
+# SQLite案例仓库：cases表保存案例，case_tags保存标签，cases_fts为标题/描述/内容的FTS5全文索引
+# 与CaseStore接口一致；多个worker共享同一个数据库文件，变更通过case_changes表互相通知
+class SqliteCaseStore:
+    def __init__(self, db_path, refresh_interval=2.0):
+        self.db_path = db_path
+        self.refresh_interval = refresh_interval
+        self._local = threading.local()
+        self._lock = threading.RLock()
+        self._write_lock = threading.RLock()  # 保存、删除和快照互斥；刷新只用_lock
+        self._listeners = []
+        self._last_seq = 0
+        self._last_check = 0.0
+        self._frozen = False
+        self._own_seqs = set()  # 本进程写入的变更序号，refresh时跳过（保存和删除时已直接通知过）
+        self._init_schema()
+
+    # 每个线程使用独立的数据库连接
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _init_schema(self):
+        conn = self._connect()
+        with conn:
+            conn.executescript('''
+                CREATE TABLE IF NOT EXISTS cases (
+                    rowid INTEGER PRIMARY KEY,
+                    id TEXT NOT NULL UNIQUE,
+                    title TEXT NOT NULL DEFAULT '',
+                    description TEXT NOT NULL DEFAULT '',
+                    content TEXT NOT NULL DEFAULT '',
+                    created_at TEXT,
+                    updated_at TEXT,
+                    data TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_cases_created ON cases(COALESCE(created_at, ''), id);
+                CREATE TABLE IF NOT EXISTS case_tags (
+                    case_id TEXT NOT NULL,
+                    tag TEXT NOT NULL,
+                    PRIMARY KEY (case_id, tag)
+                );
+                CREATE INDEX IF NOT EXISTS idx_case_tags_tag ON case_tags(tag);
+                CREATE VIRTUAL TABLE IF NOT EXISTS cases_fts USING fts5(title, description, content);
+                CREATE TABLE IF NOT EXISTS case_changes (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    case_id TEXT NOT NULL,
+                    deleted INTEGER NOT NULL DEFAULT 0
+                );
+            ''')
+        row = conn.execute('SELECT MAX(seq) FROM case_changes').fetchone()
+        self._last_seq = row[0] or 0
+
+    def subscribe(self, listener, replay=True):
+        with self._lock:
+            self._listeners.append(listener)
+            if replay:
+                for case in self._iter_cases():
+                    listener(case['id'], case)
+
+    def _notify(self, case_id, case):
+        for listener in self._listeners:
+            try:
+                listener(case_id, case)
+            except Exception as e:
+                print(f"案例变更通知 {case_id} 时出错: {str(e)}")
+
+    # 快照期间持有写锁并保持一个读事务：本进程的写入等待快照结束，其他worker的写入对快照不可见，
+    # 快照开始时同步的变更与读事务看到的数据一致；刷新在冻结时直接返回，不等待快照结束
+    @contextmanager
+    def snapshot(self):
+        with self._write_lock:
+            conn = self._connect()
+            conn.execute('BEGIN')
+            try:
+                self.refresh(force=True)
+                self._frozen = True
+                yield
+            finally:
+                self._frozen = False
+                conn.rollback()
+
+    # 把其他worker写入的变更通知给本进程的订阅者
+    def refresh(self, force=False):
+        now = time.time()
+        # 先不加锁检查，快照期间或刷新间隔内的调用不必等待锁
+        if self._frozen or (not force and now - self._last_check < self.refresh_interval):
+            return
+        with self._lock:
+            if self._frozen or (not force and now - self._last_check < self.refresh_interval):
+                return
+            self._last_check = now
+            rows = self._connect().execute(
+                'SELECT seq, case_id, deleted FROM case_changes WHERE seq > ? ORDER BY seq', (self._last_seq,)
+            ).fetchall()
+            for seq, case_id, deleted in rows:
+                self._last_seq = seq
+                if seq in self._own_seqs:
+                    continue
+                if self._listeners:
+                    self._notify(case_id, None if deleted else self._get(case_id))
+            # 本进程的变更可能已被其他worker对同一案例的新变更替换，不会再出现在case_changes中
+            self._own_seqs = {seq for seq in self._own_seqs if seq > self._last_seq}
+
+    def _iter_cases(self, limit=-1):
+        for (data,) in self._connect().execute('SELECT data FROM cases ORDER BY rowid LIMIT ?', (limit,)):
+            yield json.loads(data)
+
+    def _get(self, case_id):
+        row = self._connect().execute('SELECT data FROM cases WHERE id = ?', (case_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def all(self):
+        self.refresh()
+        return list(self._iter_cases())
+
+    def head(self, n):
+        self.refresh()
+        return list(self._iter_cases(n))
+
+    def get(self, case_id):
+        return self._get(case_id)
+
+    def count(self):
+        return self._connect().execute('SELECT COUNT(*) FROM cases').fetchone()[0]
+
+    def list_cases(self, tag=None, query=None, created_from=None, created_to=None, after=None, limit=CASE_PAGE_SIZE):
+        where, params = [], []
+        if tag:
+            where.append('id IN (SELECT case_id FROM case_tags WHERE tag = ?)')
+            params.append(tag)
+        if query:
+            # 先用FTS5短语查询缩小到候选案例，再按原文核实子串（分词会忽略标点，短语可能多匹配）
+            if len(query) >= 2 and any(ch.isalnum() for ch in query):
+                where.append('rowid IN (SELECT rowid FROM cases_fts WHERE cases_fts MATCH ?)')
+                params.append('{title description} : ' + fts_phrase(query))
+            where.append("instr(lower(title || char(10) || description), ?) > 0")
+            params.append(query.lower())
+        if created_from:
+            where.append("COALESCE(created_at, '') >= ?")
+            params.append(created_from)
+        if created_to:
+            where.append("substr(COALESCE(created_at, ''), 1, ?) <= ?")
+            params.extend([len(created_to), created_to])
+
+        conn = self._connect()
+        where_sql = ' AND '.join(where) or '1'
+        total = conn.execute(f'SELECT COUNT(*) FROM cases WHERE {where_sql}', params).fetchone()[0]
+
+        if after is not None:
+            # 单独的上界条件让SQLite直接定位到索引中的翻页位置，而不是从头扫描
+            where_sql += " AND COALESCE(created_at, '') <= ? AND (COALESCE(created_at, ''), id) < (?, ?)"
+            params = params + [after[0]] + list(after)
+        rows = conn.execute(
+            f"SELECT data FROM cases WHERE {where_sql} ORDER BY COALESCE(created_at, '') DESC, id DESC LIMIT ?",
+            params + [limit + 1]
+        ).fetchall()
+        page = [json.loads(data) for (data,) in rows]
+        next_key = case_sort_key(page[limit - 1]) if len(page) > limit else None
+        return page[:limit], next_key, total
+
+    def _record_change(self, conn, case_id, deleted):
+        conn.execute('DELETE FROM case_changes WHERE case_id = ?', (case_id,))
+        return conn.execute('INSERT INTO case_changes (case_id, deleted) VALUES (?, ?)', (case_id, int(deleted))).lastrowid
+
+    def save(self, case_id, case):
+        title = str(case.get('title') or '')
+        description = str(case.get('description') or '')
+        content = str(case.get('content') or '')
+        tags = set(t for t in (case.get('tags') or []) if isinstance(t, str))
+
+        conn = self._connect()
+        with self._write_lock, self._lock:
+            with conn:
+                conn.execute(
+                    '''INSERT INTO cases (id, title, description, content, created_at, updated_at, data)
+                       VALUES (?, ?, ?, ?, ?, ?, ?)
+                       ON CONFLICT(id) DO UPDATE SET
+                           title = excluded.title, description = excluded.description,
+                           content = excluded.content, created_at = excluded.created_at,
+                           updated_at = excluded.updated_at, data = excluded.data''',
+                    (case_id, title, description, content, case.get('created_at'), case.get('updated_at'),
+                     json.dumps(case))
+                )
+                rowid = conn.execute('SELECT rowid FROM cases WHERE id = ?', (case_id,)).fetchone()[0]
+                conn.execute('DELETE FROM cases_fts WHERE rowid = ?', (rowid,))
+                conn.execute(
+                    'INSERT INTO cases_fts (rowid, title, description, content) VALUES (?, ?, ?, ?)',
+                    (rowid, fts_ngram_text(title), fts_ngram_text(description), fts_ngram_text(content))
+                )
+                conn.execute('DELETE FROM case_tags WHERE case_id = ?', (case_id,))
+                conn.executemany('INSERT INTO case_tags (case_id, tag) VALUES (?, ?)', [(case_id, t) for t in tags])
+                seq = self._record_change(conn, case_id, False)
+            self._own_seqs.add(seq)
+            self._notify(case_id, case)
+        return case
+
+    def delete(self, case_id):
+        conn = self._connect()
+        with self._write_lock, self._lock:
+            with conn:
+                row = conn.execute('SELECT rowid FROM cases WHERE id = ?', (case_id,)).fetchone()
+                if row is None:
+                    return False
+                conn.execute('DELETE FROM cases_fts WHERE rowid = ?', (row[0],))
+                conn.execute('DELETE FROM cases WHERE rowid = ?', (row[0],))
+                conn.execute('DELETE FROM case_tags WHERE case_id = ?', (case_id,))
+                seq = self._record_change(conn, case_id, True)
+            self._own_seqs.add(seq)
+            self._notify(case_id, None)
+        return True
+
+    # 全文检索：FTS5的bm25按标题3/描述2/内容1加权，标签完全匹配按IDF加3倍权重
+    def search(self, keywords, max_cases):
+        keywords = [k for k in dict.fromkeys(keywords) if k]
+        if not keywords:
+            return []
+        conn = self._connect()
+        scores = {}
+
+        phrases = [fts_phrase(k) for k in keywords if len(k) >= 2 and any(ch.isalnum() for ch in k)]
+        if phrases:
+            rows = conn.execute(
+                '''SELECT c.id, bm25(cases_fts, 3.0, 2.0, 1.0) AS rank
+                   FROM cases_fts JOIN cases c ON c.rowid = cases_fts.rowid
+                   WHERE cases_fts MATCH ? ORDER BY rank LIMIT ?''',
+                (' OR '.join(phrases), max(max_cases * 10, 50))
+            ).fetchall()
+            for case_id, rank in rows:
+                scores[case_id] = -rank
+
+        total = self.count()
+        placeholders = ','.join('?' * len(keywords))
+        for tag, df in conn.execute(
+            f'SELECT tag, COUNT(*) FROM case_tags WHERE tag IN ({placeholders}) GROUP BY tag', keywords
+        ).fetchall():
+            idf = math.log(1 + (total - df + 0.5) / (df + 0.5))
+            for (case_id,) in conn.execute('SELECT case_id FROM case_tags WHERE tag = ?', (tag,)):
+                scores[case_id] = scores.get(case_id, 0.0) + TAG_WEIGHT * idf
+
+        ranked = heapq.nlargest(max_cases, scores.items(), key=lambda item: item[1])
+        return [(self._get(case_id), score) for case_id, score in ranked]
+
+# 将 data/cases/*.json 中的案例导入SQLite仓库（已存在的案例跳过），返回导入数量
+def migrate_json_cases(cases_dir, store):
+    imported = 0
+    if not os.path.exists(cases_dir):
+        return imported
+    for filename in sorted(os.listdir(cases_dir)):
+        if not filename.endswith('.json'):
+            continue
+        case_id = filename[:-len('.json')]
+        if store.get(case_id) is not None:
+            continue
+        try:
+            with open(os.path.join(cases_dir, filename), 'r', encoding='utf-8') as f:
+                case = json.load(f)
+        except Exception as e:
+            print(f"迁移案例文件 {filename} 时出错: {str(e)}")
+            continue
+        store.save(case_id, case)
+        imported += 1
+    return imported
+
+# 案例检索模式：keyword（关键词BM25）、weighted（原有的字段加权计分，矩阵批量计算）、
+# vector（向量语义检索）或 hybrid（关键词与向量加权融合）
+RETRIEVAL_MODE = os.environ.get('RETRIEVAL_MODE', 'keyword')
+# 混合检索中向量得分的权重（关键词得分权重为 1 - HYBRID_VECTOR_WEIGHT）
+HYBRID_VECTOR_WEIGHT = float(os.environ.get('HYBRID_VECTOR_WEIGHT', '0.5'))
+# 可选的sentence-transformers模型名称，未设置时使用本地哈希向量
+EMBEDDING_MODEL = os.environ.get('EMBEDDING_MODEL', '')
+# 计算案例向量时内容部分的最大字符数
+EMBEDDING_CONTENT_CHARS = 2000
+
+# 本地哈希向量：字符2/3-gram经crc32哈希到固定维度并带符号累加，无需下载模型，纯CPU计算
+class HashingEmbedder:
+    def __init__(self, dim=512):
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+
+    def _embed_one(self, text):
+        counts = {}
+        for n in (2, 3):
+            for i in range(len(text) - n + 1):
+                gram = text[i:i+n]
+                if gram.isspace():
+                    continue
+                h = zlib.crc32(gram.encode('utf-8'))
+                index = h % self.dim
+                counts[index] = counts.get(index, 0.0) + (1.0 if h & 0x80000000 else -1.0)
+        vector = np.zeros(self.dim, dtype=np.float32)
+        if counts:
+            indices = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+            values = np.fromiter(counts.values(), dtype=np.float32, count=len(counts))
+            # 次线性词频，避免长文本中的高频gram主导向量
+            vector[indices] = np.sign(values) * np.log1p(np.abs(values))
+        return vector
+
+    def embed(self, texts):
+        return normalize_rows(np.stack([self._embed_one(text) for text in texts]))
+
+# sentence-transformers模型（需安装sentence-transformers并设置EMBEDDING_MODEL）
+class SentenceTransformerEmbedder:
+    def __init__(self, model_name):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_name, device='cpu')
+        self.dim = self.model.get_sentence_embedding_dimension()
+        self.name = f"st-{model_name}"
+
+    def embed(self, texts):
+        return normalize_rows(np.asarray(self.model.encode(list(texts)), dtype=np.float32))
+
+# 行向量L2归一化，归一化后的点积即余弦相似度
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+def create_embedder():
+    if EMBEDDING_MODEL:
+        try:
+            return SentenceTransformerEmbedder(EMBEDDING_MODEL)
+        except Exception as e:
+            print(f"加载向量模型 {EMBEDDING_MODEL} 失败，改用哈希向量: {str(e)}")
+    return HashingEmbedder()
+
+# 案例向量索引：每个案例一行，保存在 data/case_embeddings.npz，随案例仓库增量更新
+# 案例向量为标题/描述/标签/内容向量按3/2/3/1加权求和后归一化
+class CaseVectorIndex:
+    def __init__(self, embedder, path, save_delay=5.0):
+        self.embedder = embedder
+        self.path = path
+        self.save_delay = save_delay
+        self._lock = threading.RLock()
+        self._ids = []       # 行号 -> case_id
+        self._rows = {}      # case_id -> 行号
+        self._hashes = {}    # case_id -> 案例文本摘要，用于判断向量是否需要重新计算
+        self._matrix = np.zeros((0, embedder.dim), dtype=np.float32)  # 容量可能大于案例数，有效行为前len(self._ids)行
+        self._save_timer = None
+        self._reported = set()  # 首次全量加载期间案例仓库报告过的case_id，对账完成后置为None
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with np.load(self.path, allow_pickle=False) as data:
+                if str(data['embedder']) != self.embedder.name:
+                    return
+                ids = [str(i) for i in data['ids']]
+                self._matrix = data['matrix'].astype(np.float32)
+                hashes = [str(h) for h in data['hashes']]
+        except Exception as e:
+            print(f"加载案例向量时出错: {str(e)}")
+            return
+        self._ids = ids
+        self._rows = {case_id: row for row, case_id in enumerate(ids)}
+        self._hashes = dict(zip(ids, hashes))
+
+    @staticmethod
+    def _case_texts(case):
+        return [
+            str(case.get('title') or ''),
+            str(case.get('description') or ''),
+            ' '.join(t for t in (case.get('tags') or []) if isinstance(t, str)),
+            str(case.get('content') or '')[:EMBEDDING_CONTENT_CHARS]
+        ]
+
+    def on_case_changed(self, case_id, case):
+        if self._reported is not None:
+            self._reported.add(case_id)
+        if case is None:
+            self.remove(case_id)
+        else:
+            self.update(case_id, case)
+
+    # 首次全量加载后删除向量文件中案例仓库未报告的行（服务停止期间被删除的案例）
+    def drop_unreported(self):
+        with self._lock:
+            reported, self._reported = self._reported, None
+            if reported is None:
+                return
+            stale = [case_id for case_id in self._ids if case_id not in reported]
+        for case_id in stale:
+            self.remove(case_id)
+        if stale:
+            print(f"已从案例向量索引中移除 {len(stale)} 个已删除的案例")
+
+    def update(self, case_id, case):
+        texts = self._case_texts(case)
+        digest = hashlib.sha1('\x00'.join(texts).encode('utf-8')).hexdigest()
+        with self._lock:
+            if self._hashes.get(case_id) == digest and case_id in self._rows:
+                return
+        field_vectors = self.embedder.embed(texts)
+        weights = np.array([3.0, 2.0, 3.0, 1.0], dtype=np.float32)[:, None]
+        vector = normalize_rows((field_vectors * weights).sum(axis=0, keepdims=True))[0]
+        with self._lock:
+            row = self._rows.get(case_id)
+            if row is None:
+                row = len(self._ids)
+                if row == len(self._matrix):
+                    # 按倍数扩容，避免每新增一个案例复制整个矩阵
+                    grown = np.zeros((max(16, row * 2), self.embedder.dim), dtype=np.float32)
+                    grown[:row] = self._matrix[:row]
+                    self._matrix = grown
+                self._ids.append(case_id)
+                self._rows[case_id] = row
+            self._matrix[row] = vector
+            self._hashes[case_id] = digest
+            self._schedule_save()
+
+    def remove(self, case_id):
+        with self._lock:
+            row = self._rows.pop(case_id, None)
+            if row is None:
+                return
+            self._hashes.pop(case_id, None)
+            # 用最后一行填补被删除的行
+            last = len(self._ids) - 1
+            if row != last:
+                moved_id = self._ids[last]
+                self._ids[row] = moved_id
+                self._rows[moved_id] = row
+                self._matrix[row] = self._matrix[last]
+            self._ids.pop()
+            self._schedule_save()
+
+    # 余弦相似度top-k，返回 [(case_id, 相似度)]
+    def top(self, message, k):
+        query = self.embedder.embed([message])[0]
+        with self._lock:
+            if not self._ids:
+                return []
+            scores = self._matrix[:len(self._ids)] @ query
+            k = min(k, len(self._ids))
+            candidates = np.argpartition(-scores, k - 1)[:k]
+            candidates = candidates[np.argsort(-scores[candidates])]
+            return [(self._ids[row], float(scores[row])) for row in candidates]
+
+    # 变更后延迟保存，连续修改只写一次文件
+    def _schedule_save(self):
+        if self._save_timer is not None:
+            self._save_timer.cancel()
+        self._save_timer = threading.Timer(self.save_delay, self.save)
+        self._save_timer.daemon = True
+        self._save_timer.start()
+
+    def save(self):
+        with self._lock:
+            self._save_timer = None
+            ids = np.array(self._ids, dtype=str)
+            hashes = np.array([self._hashes[case_id] for case_id in self._ids], dtype=str)
+            matrix = self._matrix[:len(self._ids)].astype(np.float16)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, ids=ids, hashes=hashes, matrix=matrix, embedder=np.array(self.embedder.name))
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            print(f"保存案例向量时出错: {str(e)}")
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+
+# 单个关键词对单个案例的加权得分（与calculate_relevance_score的标题3/描述2/内容1/标签3一致）
+def term_case_score(case, term):
+    score = 0
+    for field, _, weight in RELEVANCE_FIELDS:
+        if term in str(case.get(field) or ''):
+            score += weight
+    if term in (case.get('tags') or []):
+        score += TAG_WEIGHT
+    return score
+
+# 词表外关键词（兜底分词得到的词段、启动后新增的标签）最多缓存的得分行数，超出时淘汰最久未使用的行
+# 缓存行随使用按需分配，每行占用 案例数 个字节
+CASE_TERM_CACHE_SIZE = int(os.environ.get('CASE_TERM_CACHE_SIZE', '256'))
+
+# 词项-案例得分矩阵：行为词项，列为案例，元素为该词项对该案例的加权得分（int8）
+# 查询时所有案例的得分是一次矩阵-向量乘法；词表内的词项随案例变更增量维护，
+# 词表外的关键词首次出现时计算一行并放入有上限的LRU缓存行，同样随案例变更增量维护
+# candidate_index为同步维护的CaseIndex时，新词项只需核实倒排索引给出的候选案例
+class CaseTermMatrix:
+    def __init__(self, vocabulary=(), cache_size=CASE_TERM_CACHE_SIZE, candidate_index=None):
+        self._candidate_index = candidate_index
+        self._lock = threading.RLock()
+        self._terms = {}       # term -> 行号
+        self._ids = []         # 列号 -> case_id
+        self._columns = {}     # case_id -> 列号
+        self._cases = []       # 列号 -> 案例
+        self._seq = 0
+        # 矩阵和插入序号按列预留容量，有效列为前len(self._ids)列；插入序号用于同分时保持案例库顺序
+        self._matrix = np.zeros((0, 16), dtype=np.int8)
+        self._order = np.zeros(16, dtype=np.int64)
+        # 词表外关键词的缓存行：term -> 行号（按最近使用排序），列与主矩阵一致；行按需倍增，最多cache_size行
+        self._cache_size = cache_size
+        self._cached_terms = OrderedDict()
+        self._cache_matrix = np.zeros((0, 16), dtype=np.int8)
+        self._free_rows = []   # 词项加入词表后空出的缓存行
+        # 按字段拼接的案例文本（用\x00分隔）及每个案例的起始位置，用于快速计算新词项的得分行；案例变更后惰性重建
+        self._field_texts = None
+        self._tags_snapshot = None
+        for term in vocabulary:
+            self.add_term(term)
+
+    def _build_field_texts(self):
+        texts = {}
+        for field, _, _ in RELEVANCE_FIELDS:
+            values = [str(case.get(field) or '').replace('\x00', ' ') for case in self._cases]
+            starts = [0]
+            for value in values:
+                starts.append(starts[-1] + len(value) + 1)
+            texts[field] = ('\x00'.join(values), starts)
+        tag_columns = {}
+        for col, case in enumerate(self._cases):
+            for tag in set(t for t in (case.get('tags') or []) if isinstance(t, str)):
+                tag_columns.setdefault(tag, []).append(col)
+        self._field_texts = (texts, tag_columns)
+
+    # 计算词项对所有案例的得分行：有倒排索引时只核实候选案例，
+    # 否则在拼接文本中查找，每个命中的案例只查找一次，不逐案例循环
+    def _term_row(self, term):
+        row = np.zeros(len(self._cases), dtype=np.int8)
+        if not term:
+            return row
+        if self._candidate_index is not None:
+            for case_id in self._candidate_index.candidate_ids(term):
+                col = self._columns.get(case_id)
+                if col is not None:
+                    row[col] = term_case_score(self._cases[col], term)
+            return row
+        if self._field_texts is None:
+            self._build_field_texts()
+        texts, tag_columns = self._field_texts
+        for field, _, weight in RELEVANCE_FIELDS:
+            text, starts = texts[field]
+            cols = []
+            pos = text.find(term)
+            while pos != -1:
+                col = bisect.bisect_right(starts, pos) - 1
+                cols.append(col)
+                pos = text.find(term, starts[col + 1])
+            row[cols] += weight
+        row[tag_columns.get(term, [])] += TAG_WEIGHT
+        return row
+
+    # 把词项加入词表（计算一行并缓存）
+    def add_term(self, term):
+        with self._lock:
+            if term in self._terms:
+                return
+            row = np.zeros((1, self._matrix.shape[1]), dtype=np.int8)
+            row[0, :len(self._cases)] = self._term_row(term)
+            self._terms[term] = len(self._terms)
+            self._matrix = np.vstack([self._matrix, row])
+            cached = self._cached_terms.pop(term, None)
+            if cached is not None:
+                self._cache_matrix[cached] = 0
+                self._free_rows.append(cached)
+
+    # 词表外关键词的得分行：命中缓存直接返回，否则计算后写入最久未使用的缓存行
+    def _cached_row(self, term):
+        row = self._cached_terms.get(term)
+        if row is not None:
+            self._cached_terms.move_to_end(term)
+            return self._cache_matrix[row, :len(self._ids)]
+        if self._free_rows:
+            row = self._free_rows.pop()
+        elif len(self._cached_terms) < self._cache_size:
+            row = len(self._cached_terms)
+            if row == len(self._cache_matrix):
+                grown = np.zeros((min(max(16, row * 2), self._cache_size), self._matrix.shape[1]), dtype=np.int8)
+                grown[:row] = self._cache_matrix
+                self._cache_matrix = grown
+        else:
+            _, row = self._cached_terms.popitem(last=False)
+        self._cache_matrix[row] = 0
+        self._cache_matrix[row, :len(self._ids)] = self._term_row(term)
+        self._cached_terms[term] = row
+        return self._cache_matrix[row, :len(self._ids)]
+
+    # 词表与标签库同步：标签库在启动后新增的标签加入词表
+    def sync_tags(self, tags):
+        if tags is self._tags_snapshot:
+            return
+        self._tags_snapshot = tags
+        for category_tags in tags.get('categories', {}).values():
+            for tag in category_tags:
+                if isinstance(tag, str) and tag not in self._terms:
+                    self.add_term(tag)
+
+    def on_case_changed(self, case_id, case):
+        if case is None:
+            self.remove(case_id)
+        else:
+            self.update(case_id, case)
+
+    def update(self, case_id, case):
+        with self._lock:
+            column = np.fromiter((term_case_score(case, term) for term in self._terms), dtype=np.int8, count=len(self._terms))
+            col = self._columns.get(case_id)
+            if col is None:
+                col = len(self._ids)
+                if col == self._matrix.shape[1]:
+                    # 按倍数扩容，避免每新增一个案例复制整个矩阵
+                    matrix = np.zeros((len(self._terms), col * 2), dtype=np.int8)
+                    matrix[:, :col] = self._matrix
+                    cache_matrix = np.zeros((len(self._cache_matrix), col * 2), dtype=np.int8)
+                    cache_matrix[:, :col] = self._cache_matrix
+                    order = np.zeros(col * 2, dtype=np.int64)
+                    order[:col] = self._order
+                    self._matrix, self._cache_matrix, self._order = matrix, cache_matrix, order
+                self._ids.append(case_id)
+                self._cases.append(case)
+                self._columns[case_id] = col
+                self._seq += 1
+                self._order[col] = self._seq
+            else:
+                self._cases[col] = case
+            self._matrix[:, col] = column
+            for term, row in self._cached_terms.items():
+                self._cache_matrix[row, col] = term_case_score(case, term)
+            self._field_texts = None
+
+    def remove(self, case_id):
+        with self._lock:
+            col = self._columns.pop(case_id, None)
+            if col is None:
+                return
+            # 用最后一列填补被删除的列
+            last = len(self._ids) - 1
+            if col != last:
+                moved_id = self._ids[last]
+                self._ids[col] = moved_id
+                self._cases[col] = self._cases[last]
+                self._columns[moved_id] = col
+                self._order[col] = self._order[last]
+                self._matrix[:, col] = self._matrix[:, last]
+                self._cache_matrix[:, col] = self._cache_matrix[:, last]
+            self._cache_matrix[:, last] = 0
+            self._ids.pop()
+            self._cases.pop()
+            self._field_texts = None
+
+    # 所有案例的得分向量：查询向量（词项出现次数）与得分矩阵相乘，词表外的关键词加上缓存行
+    def scores(self, keywords):
+        with self._lock:
+            size = len(self._ids)
+            scores = np.zeros(size, dtype=np.int32)
+            query = np.zeros(len(self._terms), dtype=np.int32)
+            for keyword in keywords:
+                row = self._terms.get(keyword)
+                if row is None:
+                    scores += self._cached_row(keyword)
+                else:
+                    query[row] += 1
+            if len(self._terms):
+                scores += query @ self._matrix[:, :size]
+            return scores
+
+    # 部分选择top-k（argpartition），同分时按案例库顺序，只返回得分大于0的案例
+    def top(self, keywords, max_cases):
+        with self._lock:
+            scores = self.scores(keywords)
+            order = self._order[:len(scores)]
+            positive = np.flatnonzero(scores > 0)
+            if len(positive) > max_cases:
+                kth = np.partition(scores[positive], len(positive) - max_cases)[len(positive) - max_cases]
+                above = positive[scores[positive] > kth]
+                tied = positive[scores[positive] == kth]
+                tied = tied[np.argsort(order[tied], kind='stable')][:max_cases - len(above)]
+                positive = np.concatenate([above, tied])
+            ranked = positive[np.lexsort((order[positive], -scores[positive]))]
+            return [(self._cases[col], int(scores[col])) for col in ranked]
+
+# 全局案例仓库和案例索引（SQLite后端直接使用FTS5检索，不在内存中建立索引）
+case_index = CaseIndex()
+if CASE_STORAGE == 'sqlite':
+    case_store = SqliteCaseStore(CASES_DB_FILE)
+    if case_store.count() == 0:
+        migrated = migrate_json_cases(CASES_DIR, case_store)
+        if migrated:
+            print(f"已从 {CASES_DIR} 迁移 {migrated} 个案例到 {CASES_DB_FILE}")
+else:
+    case_store = CaseStore(CASES_DIR)
+    case_store.subscribe(case_index.on_case_changed)
+
+# 向量检索模式下建立案例向量索引
+case_vectors = None
+if RETRIEVAL_MODE in ('vector', 'hybrid'):
+    if np is None:
+        print(f"未安装numpy，检索模式 {RETRIEVAL_MODE} 不可用，改用关键词检索")
+    else:
+        case_vectors = CaseVectorIndex(create_embedder(), CASE_EMBEDDINGS_FILE)
+        case_store.subscribe(case_vectors.on_case_changed)
+
+# 字段加权计分模式下建立词项-案例得分矩阵，词表为预定义关键词和标签库中的标签
+case_terms = None
+if RETRIEVAL_MODE == 'weighted':
+    if np is None:
+        print("未安装numpy，检索模式 weighted 不可用，改用关键词检索")
+    else:
+        vocabulary = list(BUILTIN_KEYWORDS)
+        for category_tags in tags_document.read().get('categories', {}).values():
+            vocabulary.extend(category_tags)
+        # JSON后端的案例倒排索引与案例仓库同步维护，可用于快速计算词表外关键词的得分行
+        case_terms = CaseTermMatrix(
+            dict.fromkeys(vocabulary),
+            candidate_index=None if isinstance(case_store, SqliteCaseStore) else case_index
+        )
+        case_store.subscribe(case_terms.on_case_changed)
+
+# 关键词检索：按存储后端选择倒排索引或FTS5，返回 (案例, 得分) 列表
+def keyword_search_cases(keywords, max_cases):
+    if isinstance(case_store, SqliteCaseStore):
+        return case_store.search(keywords, max_cases)
+    return case_index.top(keywords, max_cases)
+
+# 向量检索：返回 (案例, 余弦相似度) 列表
+def vector_search_cases(message, max_cases):
+    ranked = []
+    for case_id, score in case_vectors.top(message, max_cases):
+        case = case_store.get(case_id)
+        if case is not None:
+            ranked.append((case, score))
+    return ranked
+
+# 混合检索：两路候选的得分各自按最高分归一化后加权求和
+def hybrid_search_cases(message, keywords, max_cases):
+    pool = max_cases * 5
+    combined = {}
+    for weight, ranked in (
+        (1 - HYBRID_VECTOR_WEIGHT, keyword_search_cases(keywords, pool)),
+        (HYBRID_VECTOR_WEIGHT, vector_search_cases(message, pool))
+    ):
+        top_score = max((score for case, score in ranked), default=0)
+        if top_score <= 0:
+            continue
+        for case, score in ranked:
+            key = case.get('id')
+            entry = combined.setdefault(key, [case, 0.0])
+            entry[1] += weight * max(score, 0) / top_score
+    ranked = heapq.nlargest(max_cases, combined.values(), key=lambda entry: entry[1])
+    return [(case, score) for case, score in ranked if score > 0]
+
+# 按检索模式检索相关案例，返回 (案例, 得分) 列表
+def search_cases(message, keywords, max_cases):
+    if case_terms is not None:
+        case_terms.sync_tags(tags_document.read())
+        return case_terms.top(keywords, max_cases)
+    if case_vectors is not None and RETRIEVAL_MODE == 'vector':
+        return vector_search_cases(message, max_cases)
+    if case_vectors is not None and RETRIEVAL_MODE == 'hybrid':
+        return hybrid_search_cases(message, keywords, max_cases)
+    return keyword_search_cases(keywords, max_cases)
+
+# 命令行迁移：flask --app app migrate-cases
+@app.cli.command('migrate-cases')
+def migrate_cases_command():
+    store = case_store if isinstance(case_store, SqliteCaseStore) else SqliteCaseStore(CASES_DB_FILE)
+    print(f"已迁移 {migrate_json_cases(CASES_DIR, store)} 个案例到 {CASES_DB_FILE}")
+
+# 根据关键词匹配相关案例，with_scores为True时返回 (案例, 得分) 列表
+def find_relevant_cases(message, cases=None, max_cases=3, with_scores=False, keywords=None):
+    # 提取关键词（调用方已提取时直接复用）
+    if keywords is None:
+        keywords = extract_keywords(message)
     
-    # 管理主题关键词
-    topic_keywords = [
-        "战略规划", "组织变革", "流程优化", "数字化转型", "人才管理", "绩效管理", "企业文化",
-        "领导力", "创新", "市场营销", "供应链", "财务管理", "风险管理", "质量管理",
-        "成本控制", "客户关系", "并购", "国际化", "产品开发", "技术创新"
-    ]
+    # 未指定案例列表时按检索模式使用案例库的索引（关键词BM25F / 向量 / 混合）
+    if cases is None:
+        case_store.refresh()
+        ranked = search_cases(message, keywords, max_cases)
+        if len(ranked) < max_cases:
+            # 命中不足时与原逻辑一致，用案例库中未命中的案例补足
+            picked = set(case.get('id') for case, score in ranked)
+            for case in case_store.head(max_cases + len(ranked)):
+                if len(ranked) >= max_cases:
+                    break
+                if case.get('id') not in picked:
+                    ranked.append((case, 0.0))
+    else:
+        if not cases:
+            return []
+        
+        # 计算每个案例的相关性得分
+        scored_cases = []
+        for case in cases:
+            score = calculate_relevance_score(case, keywords)
+            scored_cases.append((case, score))
+        
+        # 按相关性得分排序并返回前N个案例
+        scored_cases.sort(key=lambda x: x[1], reverse=True)
+        ranked = scored_cases[:max_cases]
     
-    # 提取所有可能的关键词
-    all_keywords = industry_keywords + size_keywords + topic_keywords
+    if with_scores:
+        return ranked
+    return [case for case, score in ranked]
+
+# Aho-Corasick多模式匹配自动机：一次线性扫描找出文本中出现的所有关键词
+class KeywordMatcher:
+    def __init__(self, keywords):
+        self.keywords = list(dict.fromkeys(k for k in keywords if k))
+        self._goto = [{}]     # 状态 -> {字符: 下一状态}
+        self._fail = [0]      # 状态 -> 失配跳转状态
+        self._output = [()]   # 状态 -> 在该状态结束的关键词序号
+        
+        for index, keyword in enumerate(self.keywords):
+            state = 0
+            for ch in keyword:
+                next_state = self._goto[state].get(ch)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append(())
+                    self._goto[state][ch] = next_state
+                state = next_state
+            self._output[state] = self._output[state] + (index,)
+        
+        # 按广度优先构建失配指针，并合并后缀状态的输出
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(ch, 0)
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
     
-    # 找出消息中包含的关键词
-    found_keywords = []
-    for keyword in all_keywords:
-        if keyword in message:
-            found_keywords.append(keyword)
+    # 返回文本中出现的关键词（按词表顺序，不重复）
+    def find_all(self, text):
+        goto, fail, output = self._goto, self._fail, self._output
+        found = set()
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if output[state]:
+                found.update(output[state])
+        return [self.keywords[index] for index in sorted(found)]
+
+# 关键词匹配器：词表为预定义关键词加标签库中的所有标签，标签库变化时重建
+_keyword_matcher = None
+_keyword_matcher_tags = None
+_keyword_matcher_lock = threading.Lock()
+
+def get_keyword_matcher():
+    global _keyword_matcher, _keyword_matcher_tags
+    tags = tags_document.read()
+    if _keyword_matcher is not None and tags is _keyword_matcher_tags:
+        return _keyword_matcher
+    with _keyword_matcher_lock:
+        if _keyword_matcher is None or tags is not _keyword_matcher_tags:
+            vocabulary = list(BUILTIN_KEYWORDS)
+            for category_tags in tags.get('categories', {}).values():
+                vocabulary.extend(t for t in category_tags if isinstance(t, str))
+            _keyword_matcher = KeywordMatcher(vocabulary)
+            _keyword_matcher_tags = tags
+        return _keyword_matcher
+
+# 兜底分词的停用词：作为分隔符把消息切成词段
+FALLBACK_STOPWORDS = [
+    "为什么", "什么", "如何", "怎么样", "怎么", "请问", "谢谢", "帮我", "我想", "可以", "需要",
+    "我们", "你们", "他们", "是否", "应该", "有没有", "一下", "哪些", "的", "了", "吗", "呢", "和", "与", "及"
+]
+FALLBACK_KEYWORD_LIMIT = 8
+
+# 按标点、空白和停用词切分的正则（停用词按长度降序，优先匹配长词）
+_FALLBACK_SPLIT_RE = re.compile(
+    r'[\s\W_]+|' + '|'.join(re.escape(w) for w in sorted(FALLBACK_STOPWORDS, key=len, reverse=True))
+)
+
+# 词段内再按英文数字与中文分开
+_FALLBACK_RUN_RE = re.compile(r'[A-Za-z0-9]+|[^\x00-\x7f]+')
+
+# 兜底分词：没有命中词表时，以停用词和标点切分消息，2-4字的词段整体作为关键词，
+# 更长的中文词段取双字词，英文和数字词段整体保留
+def fallback_tokenize(message, limit=FALLBACK_KEYWORD_LIMIT):
+    keywords = []
+    segments = []
+    for part in _FALLBACK_SPLIT_RE.split(message):
+        segments.extend(_FALLBACK_RUN_RE.findall(part))
+    for segment in segments:
+        if len(segment) < 2:
+            continue
+        if segment.isascii() or len(segment) <= 4:
+            candidates = [segment]
+        else:
+            candidates = [segment[i:i+2] for i in range(len(segment) - 1)]
+        for candidate in candidates:
+            if candidate not in keywords:
+                keywords.append(candidate)
+                if len(keywords) >= limit:
+                    return keywords
+    return keywords
+
+# 提取关键词
+def extract_keywords(message):
+    # 找出消息中包含的预定义关键词和标签
+    found_keywords = get_keyword_matcher().find_all(message)
     
-    # 如果没有找到预定义关键词，则提取消息中的名词和形容词作为关键词
+    # 如果没有找到预定义关键词，则用兜底分词提取关键词
     if not found_keywords:
-        # 简单分词，提取2-4字词语作为可能的关键词
-        words = []
-        for i in range(len(message)):
-            for j in range(2, 5):  # 提取2-4字词
-                if i + j <= len(message):
-                    words.append(message[i:i+j])
-        
-        # 过滤掉常见的停用词
-        stopwords = ["什么", "如何", "为什么", "怎么", "请问", "谢谢", "帮我", "我想", "可以", "需要"]
-        words = [w for w in words if w not in stopwords]
-        
-        found_keywords = words[:5]  # 限制关键词数量
+        found_keywords = fallback_tokenize(message)
     
     return found_keywords
 
@@ -247,251 +1789,1273 @@ def calculate_relevance_score(case, keywords):
     
     return score
 
-# 格式化案例为AI可读格式
-def format_cases_for_ai(cases):
-    if not cases:
-        return "目前没有找到相关案例。"
+# 系统提示的token预算（估算值），超出时截取案例中与问题最相关的句子
+PROMPT_TOKEN_BUDGET = int(os.environ.get('PROMPT_TOKEN_BUDGET', '4000'))
+# 案例内容至少保留的token预算（搜索结果较长时也不低于该值）
+CASE_CONTEXT_MIN_TOKENS = 400
+# token估算比例：DeepSeek分词下中文约0.6 token/字，其他字符约0.3 token/字
+TOKENS_PER_CJK_CHAR = 0.6
+TOKENS_PER_OTHER_CHAR = 0.3
+# 每个案例的标题、描述和标签合计的token上限（描述较长时截断）
+CASE_HEAD_TOKENS = 150
+# 截取的句子不连续时使用的连接符
+PASSAGE_ELLIPSIS = "……"
+
+_CJK_CHAR_RE = re.compile(r'[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]')
+_SENTENCE_SPLIT_RE = re.compile(r'(?<=[。！？；!?;])|\n+')
+
+# 估算文本的token数
+def estimate_tokens(text):
+    if not text:
+        return 0
+    cjk = len(_CJK_CHAR_RE.findall(text))
+    return math.ceil(cjk * TOKENS_PER_CJK_CHAR + (len(text) - cjk) * TOKENS_PER_OTHER_CHAR)
+
+# 按句末标点和换行拆分句子
+def split_sentences(text):
+    return [sentence.strip() for sentence in _SENTENCE_SPLIT_RE.split(text) if sentence and sentence.strip()]
+
+# 按token预算截断文本
+def truncate_to_tokens(text, token_budget):
+    if estimate_tokens(text) <= token_budget:
+        return text
+    end = max(int(token_budget / TOKENS_PER_CJK_CHAR), 1)
+    while end < len(text) and estimate_tokens(text[:end + 1]) <= token_budget:
+        end += 1
+    while end > 1 and estimate_tokens(text[:end]) > token_budget:
+        end -= 1
+    return text[:end] + PASSAGE_ELLIPSIS
+
+# 在token预算内挑选与关键词最相关的句子，按原文顺序拼接，返回 (文本, 是否截取)
+def select_passages(content, keywords, token_budget):
+    if estimate_tokens(content) <= token_budget:
+        return content, False
+    sentences = split_sentences(content)
+    if not sentences:
+        return "", False
     
-    formatted_text = "以下是与您咨询问题相关的案例详情：\n\n"
+    costs = [estimate_tokens(sentence) for sentence in sentences]
+    scores = [sum(sentence.count(keyword) for keyword in keywords or []) for sentence in sentences]
     
+    # 命中关键词多的句子优先，同分时靠前的句子优先
+    chosen = []
+    used = 0
+    for i in sorted(range(len(sentences)), key=lambda i: (-scores[i], i)):
+        if used + costs[i] <= token_budget:
+            chosen.append(i)
+            used += costs[i]
+    if not chosen:
+        best = max(range(len(sentences)), key=lambda i: (scores[i], -i))
+        return truncate_to_tokens(sentences[best], token_budget), True
+    
+    chosen.sort()
+    parts = [PASSAGE_ELLIPSIS] if chosen[0] > 0 else []
+    for prev, i in zip([None] + chosen, chosen):
+        if prev is not None and i != prev + 1:
+            parts.append(PASSAGE_ELLIPSIS)
+        parts.append(sentences[i])
+    if chosen[-1] < len(sentences) - 1:
+        parts.append(PASSAGE_ELLIPSIS)
+    return "".join(parts), True
+
+# 合并段落区间，按原文顺序拼接，不连续处用省略号连接
+def merge_passages(content, spans):
+    merged = []
+    for start, end in sorted(spans):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    parts = [PASSAGE_ELLIPSIS] if merged[0][0] > 0 else []
+    for i, (start, end) in enumerate(merged):
+        if i:
+            parts.append(PASSAGE_ELLIPSIS)
+        parts.append(content[start:end])
+    if merged[-1][1] < len(content):
+        parts.append(PASSAGE_ELLIPSIS)
+    return "".join(parts)
+
+# 按token预算打包案例内容，返回 (文本, 被截取的案例数)
+# passages为段落索引检索出的 {case_id: [(起始位置, 结束位置, 得分)]}，较长的案例只保留命中的段落
+# 标题、描述和标签每个案例合计不超过CASE_HEAD_TOKENS（也不超过平均预算），其中标题和标签各占至多四分之一
+# 剩余预算按注水法分给各案例的详细内容：内容较短的案例完整保留，省下的预算留给较长的案例
+def pack_cases_for_ai(cases, keywords=None, token_budget=None, passages=None):
+    if not cases:
+        return "目前没有找到相关案例。", 0
+    
+    heads = []
+    contents = []
+    trimmed = []
     for i, case in enumerate(cases, 1):
-        formatted_text += f"案例{i}：{case.get('title', '无标题')}\n"
-        formatted_text += f"描述：{case.get('description', '无描述')}\n"
-        formatted_text += f"标签：{', '.join(case.get('tags', []))}\n"
-        formatted_text += f"详细内容：{case.get('content', '无内容')}\n\n"
+        title = str(case.get('title') or '无标题')
+        description = str(case.get('description') or '无描述')
+        tags = ', '.join(str(tag) for tag in case.get('tags') or [])
+        original = (title, description, tags)
+        if token_budget is not None:
+            head_budget = min(CASE_HEAD_TOKENS, max(token_budget // len(cases), 4))
+            title = truncate_to_tokens(title, head_budget // 4)
+            tags = truncate_to_tokens(tags, head_budget // 4)
+            description = truncate_to_tokens(description, head_budget - estimate_tokens(title) - estimate_tokens(tags))
+        head_trimmed = (title, description, tags) != original
+        heads.append(
+            f"案例{i}：{title}\n"
+            f"描述：{description}\n"
+            f"标签：{tags}\n"
+            "详细内容："
+        )
+        content = str(case.get('content') or '无内容')
+        spans = (passages or {}).get(case.get('id'))
+        if spans and len(content) > PASSAGE_SIZE * PASSAGES_PER_CASE:
+            contents.append(merge_passages(content, [(start, end) for start, end, _ in spans]))
+            trimmed.append(True)
+        else:
+            contents.append(content)
+            trimmed.append(head_trimmed)
+    
+    if token_budget is not None:
+        remaining = token_budget - sum(estimate_tokens(head) for head in heads)
+        costs = [estimate_tokens(content) for content in contents]
+        budgets = [0] * len(cases)
+        pending = sorted(range(len(cases)), key=lambda i: costs[i])
+        for n, i in enumerate(pending):
+            budgets[i] = min(costs[i], max(remaining, 0) // (len(pending) - n))
+            remaining -= budgets[i]
+    
+    truncated = 0
+    parts = ["以下是与您咨询问题相关的案例详情：\n\n"]
+    for i, head in enumerate(heads):
+        content = contents[i]
+        was_truncated = trimmed[i]
+        if token_budget is not None:
+            content, over_budget = select_passages(content, keywords, budgets[i])
+            was_truncated = was_truncated or over_budget
+        truncated += was_truncated
+        parts.append(head)
+        parts.append(content)
+        parts.append("\n\n")
+    
+    return "".join(parts), truncated
+
+# 线程安全的TTL + LRU缓存：条目超过ttl秒过期，超过max_entries时淘汰最久未使用的条目
+class TTLCache:
+    def __init__(self, max_entries, ttl, on_evict=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.on_evict = on_evict  # 条目过期或被挤出时回调，参数为 [(key, 值)]
+        self._data = OrderedDict()  # key -> (过期时间, 值)
+        self._lock = threading.Lock()
+
+    def _evicted(self, entries):
+        if entries and self.on_evict is not None:
+            self.on_evict(entries)
+
+    def _trim(self):
+        evicted = []
+        while len(self._data) > self.max_entries:
+            key, (expires_at, value) = self._data.popitem(last=False)
+            evicted.append((key, value))
+        return evicted
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at > time.time():
+                self._data.move_to_end(key)
+                return value
+            del self._data[key]
+        self._evicted([(key, value)])
+        return default
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (time.time() + (self.ttl if ttl is None else ttl), value)
+            self._data.move_to_end(key)
+            evicted = self._trim()
+        self._evicted(evicted)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            return default if entry is None else entry[1]
+
+    def clear(self):
+        with self._lock:
+            evicted = [(key, value) for key, (expires_at, value) in self._data.items()]
+            self._data.clear()
+        self._evicted(evicted)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    # 导出未过期的条目 [(key, 过期时间, 值)]，按最近使用顺序排列
+    def dump(self):
+        now = time.time()
+        with self._lock:
+            return [(key, expires_at, value) for key, (expires_at, value) in self._data.items() if expires_at > now]
+
+    def load(self, entries):
+        now = time.time()
+        with self._lock:
+            for key, expires_at, value in entries:
+                if expires_at > now:
+                    self._data[key] = (expires_at, value)
+                    self._data.move_to_end(key)
+            evicted = self._trim()
+        self._evicted(evicted)
+
+# 网络搜索结果缓存设置：有效期（秒）、最大条目数，以及是否持久化到data目录
+SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL', str(6 * 3600)))
+SEARCH_CACHE_MAX_ENTRIES = int(os.environ.get('SEARCH_CACHE_MAX_ENTRIES', '1000'))
+SEARCH_CACHE_PERSIST = os.environ.get('SEARCH_CACHE_PERSIST', '1') == '1'
+SEARCH_CACHE_SAVE_DELAY = 5.0
+
+search_cache = TTLCache(SEARCH_CACHE_MAX_ENTRIES, SEARCH_CACHE_TTL)
+
+# 规范化搜索查询：统一全角/半角、大小写和空白，作为缓存键的一部分
+def normalize_search_query(query):
+    return ' '.join(unicodedata.normalize('NFKC', query).lower().split())
+
+def search_cache_key(query, num_results):
+    return f"{num_results}:{normalize_search_query(query)}"
+
+# 从data目录加载持久化的搜索缓存
+def load_search_cache():
+    if not SEARCH_CACHE_PERSIST or not os.path.exists(SEARCH_CACHE_FILE):
+        return
+    try:
+        with open(SEARCH_CACHE_FILE, 'r', encoding='utf-8') as f:
+            search_cache.load(json.load(f))
+    except Exception as e:
+        print(f"加载搜索缓存时出错: {str(e)}")
+
+_search_cache_save_timer = None
+_search_cache_save_lock = threading.Lock()
+
+# 将搜索缓存写入data目录：在文件锁内与文件中其他worker保存的条目合并，同一查询保留过期时间较晚的结果
+def save_search_cache():
+    global _search_cache_save_timer
+    with _search_cache_save_lock:
+        _search_cache_save_timer = None
+    if not SEARCH_CACHE_PERSIST:
+        return
+    try:
+        with file_lock(SEARCH_CACHE_FILE):
+            merged = OrderedDict()
+            if os.path.exists(SEARCH_CACHE_FILE):
+                try:
+                    with open(SEARCH_CACHE_FILE, 'r', encoding='utf-8') as f:
+                        for key, expires_at, value in json.load(f):
+                            merged[key] = (expires_at, value)
+                except ValueError as e:
+                    print(f"读取搜索缓存文件时出错: {str(e)}")
+            for key, expires_at, value in search_cache.dump():
+                if key not in merged or merged[key][0] <= expires_at:
+                    merged.pop(key, None)
+                    merged[key] = (expires_at, value)
+            now = time.time()
+            entries = [[key, expires_at, value] for key, (expires_at, value) in merged.items() if expires_at > now]
+            atomic_write_json(SEARCH_CACHE_FILE, entries[-SEARCH_CACHE_MAX_ENTRIES:])
+    except Exception as e:
+        print(f"保存搜索缓存时出错: {str(e)}")
+
+# 新的搜索结果延迟保存：已有待执行的保存时直接并入，最多每SEARCH_CACHE_SAVE_DELAY秒写一次文件
+def schedule_search_cache_save():
+    global _search_cache_save_timer
+    if not SEARCH_CACHE_PERSIST:
+        return
+    with _search_cache_save_lock:
+        if _search_cache_save_timer is not None:
+            return
+        _search_cache_save_timer = threading.Timer(SEARCH_CACHE_SAVE_DELAY, save_search_cache)
+        _search_cache_save_timer.daemon = True
+        _search_cache_save_timer.start()
+
+load_search_cache()
+
+# 搜索结果HTML解析器：安装了lxml时使用更快的lxml，否则使用内置的html.parser
+try:
+    import lxml  # noqa: F401
+    SEARCH_HTML_PARSER = os.environ.get('SEARCH_HTML_PARSER', 'lxml')
+except ImportError:
+    SEARCH_HTML_PARSER = os.environ.get('SEARCH_HTML_PARSER', 'html.parser')
+
+# Bing搜索结果条目的起始标签：class中包含完整的b_algo类名的<li>
+# 结果内部的 class="b_algoheader" 等同前缀类名不算新的结果
+SEARCH_RESULT_START_RE = re.compile(r"""<li\b[^>]*\bclass=(["'])(?:[^"']*\s)?b_algo(?:\s[^"']*)?\1""")
+# 解析时匹配class属性中的b_algo类名（class可能包含多个类名，如 "b_algo b_vtl_deeplinks"）
+SEARCH_RESULT_CLASS_RE = re.compile(r'(?:^|\s)b_algo(?:\s|$)')
+
+# 网络搜索的HTTP设置：连接/读取超时、重试次数和单次搜索的总耗时预算（秒）
+SEARCH_CONNECT_TIMEOUT = 3
+SEARCH_READ_TIMEOUT = 5
+SEARCH_MAX_RETRIES = 2
+SEARCH_RETRY_BACKOFF = 0.3
+SEARCH_TIME_BUDGET = 8
+SEARCH_RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# 创建共享的搜索HTTP会话，复用到Bing的keep-alive连接
+def create_search_http_session():
+    http_session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=0)
+    http_session.mount('https://', adapter)
+    http_session.mount('http://', adapter)
+    # 设置请求头，模拟浏览器访问
+    http_session.headers.update({
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+    })
+    return http_session
+
+search_http_session = create_search_http_session()
+
+# 在耗时预算内获取搜索页面，超时或服务端错误时有限次重试，预算用尽返回None
+def fetch_search_page(url, time_budget=SEARCH_TIME_BUDGET):
+    deadline = time.monotonic() + time_budget
+    for attempt in range(SEARCH_MAX_RETRIES + 1):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            response = search_http_session.get(
+                url,
+                timeout=(min(SEARCH_CONNECT_TIMEOUT, remaining), min(SEARCH_READ_TIMEOUT, remaining))
+            )
+            if response.status_code not in SEARCH_RETRY_STATUS:
+                response.raise_for_status()
+                return response
+            print(f"网络搜索返回状态码 {response.status_code}，第{attempt + 1}次尝试")
+        except (requests.ConnectionError, requests.Timeout) as e:
+            print(f"网络搜索请求失败，第{attempt + 1}次尝试: {str(e)}")
+        
+        backoff = SEARCH_RETRY_BACKOFF * (2 ** attempt)
+        if attempt < SEARCH_MAX_RETRIES and time.monotonic() + backoff < deadline:
+            time.sleep(backoff)
     
-    return formatted_text
+    print(f"网络搜索超出耗时预算（{time_budget}秒），跳过搜索结果")
+    return None
 
-# 网络搜索功能
-def web_search(query, num_results=3):
+# 网络搜索功能（带结果缓存）
+def web_search(query, num_results=3, time_budget=SEARCH_TIME_BUDGET):
+    cache_key = search_cache_key(query, num_results)
+    cached = search_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    
+    search_results = fetch_web_search_results(query, num_results, time_budget)
+    
+    # 只缓存成功的搜索，失败或超时的查询下次重新搜索
+    if search_results:
+        search_cache.set(cache_key, search_results)
+        schedule_search_cache_save()
+    return search_results
+
+# 从Bing获取并解析搜索结果
+def fetch_web_search_results(query, num_results=3, time_budget=SEARCH_TIME_BUDGET):
     try:
         # 构建搜索URL
         search_url = f"https://www.bing.com/search?q={urllib.parse.quote(query)}"
         
-        # 设置请求头，模拟浏览器访问
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }
-        
-        # 发送请求
-        response = requests.get(search_url, headers=headers)
-        response.raise_for_status()
+        # 发送请求（超出耗时预算时不使用搜索结果）
+        response = fetch_search_page(search_url, time_budget)
+        if response is None:
+            return []
         
         # 解析HTML
-        soup = BeautifulSoup(response.text, 'html.parser')
-        
-        # 提取搜索结果
-        search_results = []
-        result_elements = soup.select('.b_algo')[:num_results]
-        
-        for element in result_elements:
-            title_element = element.select_one('h2 a')
-            if not title_element:
-                continue
-                
-            title = title_element.get_text()
-            link = title_element.get('href', '')
-            
-            # 提取摘要
-            snippet_element = element.select_one('.b_caption p')
-            snippet = snippet_element.get_text() if snippet_element else "无摘要"
-            
-            search_results.append({
-                'title': title,
-                'link': link,
-                'snippet': snippet
-            })
-        
-        return search_results
+        return parse_search_results(response.text, num_results)
     except Exception as e:
         print(f"网络搜索出错: {str(e)}")
         return []
 
+# 截取搜索结果所在的HTML片段：从第一条结果开始，到第num_results条结果结束，
+# 页头脚本、样式和侧栏都不再交给解析器
+def slice_search_results_html(html, num_results):
+    matches = SEARCH_RESULT_START_RE.finditer(html)
+    first = next(matches, None)
+    if first is None:
+        return html
+    
+    for _ in range(num_results):
+        end = next(matches, None)
+        if end is None:
+            return html[first.start():]
+    return html[first.start():end.start()]
+
+# 解析Bing搜索结果页面，只构建结果条目的节点树
+def parse_search_results(html, num_results=3, parser=None):
+    soup = BeautifulSoup(
+        slice_search_results_html(html, num_results),
+        parser or SEARCH_HTML_PARSER,
+        parse_only=SoupStrainer('li', class_=SEARCH_RESULT_CLASS_RE)
+    )
+    
+    # 提取搜索结果
+    search_results = []
+    result_elements = soup.select('.b_algo')[:num_results]
+    
+    for element in result_elements:
+        title_element = element.select_one('h2 a')
+        if not title_element:
+            continue
+            
+        title = title_element.get_text()
+        link = title_element.get('href', '')
+        
+        # 提取摘要
+        snippet_element = element.select_one('.b_caption p')
+        snippet = snippet_element.get_text() if snippet_element else "无摘要"
+        
+        search_results.append({
+            'title': title,
+            'link': link,
+            'snippet': snippet
+        })
+    
+    return search_results
+
 # 格式化搜索结果为AI可读格式
 def format_search_results_for_ai(results, query):
     if not results:
         return f"未能找到关于\"{query}\"的搜索结果。"
     
-    formatted_text = f"以下是关于\"{query}\"的网络搜索结果：\n\n"
+    parts = [f"以下是关于\"{query}\"的网络搜索结果：\n\n"]
     
     for i, result in enumerate(results, 1):
-        formatted_text += f"结果{i}：{result['title']}\n"
-        formatted_text += f"链接：{result['link']}\n"
-        formatted_text += f"摘要：{result['snippet']}\n\n"
+        parts.append(f"结果{i}：{result['title']}\n链接：{result['link']}\n摘要：{result['snippet']}\n\n")
+    
+    return "".join(parts)
+
+# 网络搜索线程池：搜索与本地案例检索并行执行，线程数限制同时进行的外部请求
+SEARCH_POOL_SIZE = int(os.environ.get('SEARCH_POOL_SIZE', '8'))
+# 等待搜索结果的最长时间（秒），从提交搜索开始计算
+SEARCH_JOIN_DEADLINE = SEARCH_TIME_BUDGET + 1
+
+search_executor = ThreadPoolExecutor(max_workers=SEARCH_POOL_SIZE, thread_name_prefix='web-search')
+
+# 在截止时间内等待搜索结果，超时则放弃搜索
+def wait_for_search(future, deadline):
+    try:
+        return future.result(timeout=max(0, deadline - time.monotonic()))
+    except FutureTimeoutError:
+        future.cancel()
+        print("网络搜索超过等待时间，跳过搜索结果")
+    except Exception as e:
+        print(f"网络搜索出错: {str(e)}")
+    return []
+
+# 系统提示的固定前缀：所有请求逐字节相同，DeepSeek的上下文硬盘缓存可以命中这一段
+# 案例内容、搜索结果等动态内容按固定顺序追加在前缀之后
+SYSTEM_PROMPT_PREFIX = """你是写春秋企业管理咨询的AI助手，专注于为企业提供专业的管理咨询建议。
+你可以访问并分析公司的案例库，为用户提供基于实际案例的专业建议。
+你还具备深度思考能力，可以进行多步骤推理和全面分析，并能通过网络搜索获取最新信息。
+
+在回答用户问题时，请遵循以下原则：
+1. 分析用户问题，提取关键需求和管理主题
+2. 参考相关案例库内容，提供有针对性的建议
+3. 引用案例中的具体经验和数据支持你的建议
+4. 进行深度思考，从多个角度分析问题
+5. 当需要最新信息时，参考网络搜索结果
+6. 提供结构化的分析框架和实施步骤
+7. 保持专业、严谨的咨询顾问语气
+
+如果用户询问特定行业或管理问题，请基于下方的案例和搜索结果提供详细分析。如果案例库中没有完全匹配的案例，可以基于管理理论和最佳实践提供建议，但要明确说明这是基于理论而非具体案例。
+
+在回答时，请采用以下结构：
+1. 问题分析：简要概述用户问题的核心需求和关键点
+2. 案例参考：引用相关案例中的经验和数据
+3. 深度思考：从多个角度分析问题，考虑不同因素和可能的影响
+4. 行业洞察：结合最新行业趋势和数据（如有网络搜索结果）
+5. 建议方案：提供具体、可操作的解决方案和实施步骤
+6. 预期效果：分析方案可能带来的效果和潜在风险
+
+"""
+SYSTEM_PROMPT_CASES_HEADING = "案例库内容：\n"
+SYSTEM_PROMPT_STATIC_TOKENS = estimate_tokens(SYSTEM_PROMPT_PREFIX + SYSTEM_PROMPT_CASES_HEADING)
+
+# 组装系统提示：固定前缀，然后依次是案例内容和搜索结果（没有搜索时省略）
+def build_system_prompt(case_content, search_content):
+    parts = [SYSTEM_PROMPT_PREFIX, SYSTEM_PROMPT_CASES_HEADING, case_content]
+    if search_content:
+        parts.append("\n")
+        parts.append(search_content)
+    return "".join(parts)
+
+# 多轮对话设置：保留的完整轮数（更早的轮次压缩为摘要）、摘要的token上限和对话有效期（秒）
+CONVERSATION_MAX_TURNS = int(os.environ.get('CONVERSATION_MAX_TURNS', '6'))
+CONVERSATION_SUMMARY_TOKENS = 800
+CONVERSATION_TTL = int(os.environ.get('CONVERSATION_TTL', str(24 * 3600)))
+# 摘要中每轮问题和回答保留的token数
+SUMMARY_QUESTION_TOKENS = 60
+SUMMARY_ANSWER_TOKENS = 120
+
+# 将一轮对话压缩为摘要：保留问题和回答开头的部分
+def summarize_turn(turn):
+    question = truncate_to_tokens(' '.join(turn['user'].split()), SUMMARY_QUESTION_TOKENS)
+    answer = truncate_to_tokens(' '.join(turn['assistant'].split()), SUMMARY_ANSWER_TOKENS)
+    return f"用户：{question}\n顾问：{answer}"
+
+# 服务端多轮对话：每个对话一个JSON文件（data/conversations/<id>.json），多个worker共享
+# 最近的若干轮完整保留，更早的轮次压缩进摘要；每轮新引用的案例作为该轮的上下文消息随轮次保存
+class ConversationStore:
+    def __init__(self, directory, max_turns, ttl, prune_interval=600):
+        self.directory = directory
+        self.max_turns = max_turns
+        self.ttl = ttl
+        self.prune_interval = prune_interval
+        self._last_prune = 0.0
+
+    def _path(self, conversation_id):
+        return os.path.join(self.directory, f"{conversation_id}.json")
+
+    def get(self, conversation_id):
+        if not isinstance(conversation_id, str) or not re.fullmatch(r'[0-9a-f]{32}', conversation_id):
+            return None
+        try:
+            with open(self._path(conversation_id), 'r', encoding='utf-8') as f:
+                conversation = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if conversation.get('updated_at', 0) + self.ttl < time.time():
+            return None
+        return conversation
+
+    # 继续已有对话，不存在或已过期时新建对话（首轮回答后才写入文件）
+    def get_or_create(self, conversation_id):
+        conversation = self.get(conversation_id)
+        if conversation is None:
+            conversation = {
+                "id": uuid.uuid4().hex,
+                "summary": [],
+                "turns": [],
+                "updated_at": time.time()
+            }
+        return conversation
+
+    # 发给模型的历史消息：较早轮次的摘要和最近的完整轮次（各轮新引用的案例放在该轮问题之前）
+    def history_messages(self, conversation):
+        messages = []
+        if conversation['summary']:
+            messages.append({"role": "system", "content": "此前对话摘要：\n" + "\n".join(conversation['summary'])})
+        for turn in conversation['turns']:
+            if turn.get('context'):
+                messages.append({"role": "system", "content": turn['context']})
+            messages.append({"role": "user", "content": turn['user']})
+            messages.append({"role": "assistant", "content": turn['assistant']})
+        return messages
+
+    # 对话中已注入的案例ID（压缩进摘要的轮次的案例不再计入，之后可以重新注入）
+    def case_ids(self, conversation):
+        return {case_id for turn in conversation['turns'] for case_id, score in turn.get('case_refs', [])}
+
+    # 记录一轮问答，连同本轮新注入的案例上下文和案例引用
+    def record_turn(self, conversation, message, text, context):
+        path = self._path(conversation['id'])
+        with file_lock(path):
+            latest = self.get(conversation['id']) or conversation
+            latest['turns'].append({
+                "user": message,
+                "assistant": text,
+                "context": context['case_context'],
+                "case_refs": context['case_refs']
+            })
+            while len(latest['turns']) > self.max_turns:
+                latest['summary'].append(summarize_turn(latest['turns'].pop(0)))
+            while len(latest['summary']) > 1 and estimate_tokens("\n".join(latest['summary'])) > CONVERSATION_SUMMARY_TOKENS:
+                latest['summary'].pop(0)
+            latest['updated_at'] = time.time()
+            atomic_write_json(path, latest)
+        self.prune()
+
+    # 删除过期的对话文件及其锁文件（锁文件打开时不更新mtime，只随过期的对话一起删除）
+    def prune(self):
+        now = time.time()
+        if now - self._last_prune < self.prune_interval:
+            return
+        self._last_prune = now
+        try:
+            for name in os.listdir(self.directory):
+                if not name.endswith('.json'):
+                    continue
+                path = os.path.join(self.directory, name)
+                if os.path.getmtime(path) + self.ttl >= now:
+                    continue
+                with file_lock(path):
+                    # 加锁后再检查一次，跳过刚被其他请求续写的对话
+                    if os.path.getmtime(path) + self.ttl >= time.time():
+                        continue
+                    os.unlink(path)
+                    if os.path.exists(f"{path}.lock"):
+                        os.unlink(f"{path}.lock")
+        except OSError as e:
+            print(f"清理过期对话时出错: {str(e)}")
+
+conversation_store = ConversationStore(CONVERSATIONS_DIR, CONVERSATION_MAX_TURNS, CONVERSATION_TTL)
+
+# 准备对话上下文：相关案例、网络搜索结果、系统提示和发给模型的消息
+# 每轮都重新检索案例；多轮对话中系统提示只含固定说明，本轮检索到的案例里对话尚未引用过的
+# 作为新的上下文消息追加在历史之后，已引用过的案例留在历史中不再重复发送
+# scored_cases为调用方已检索好的 (案例, 得分) 列表时直接使用（批量咨询在同一份快照上预先检索）
+def prepare_ai_context(message, cases=None, settings=None, conversation=None, scored_cases=None):
+    settings = settings or settings_service.get()
     
-    return formatted_text
+    # 获取API设置
+    api_key = settings.api_key
+    temperature = settings.temperature
+    
+    # 提取关键词，案例检索和搜索查询共用
+    keywords = extract_keywords(message)
+    
+    # 判断是否需要网络搜索，需要时先在线程池中发起搜索
+    need_search, search_query = classify_search_intent(message, keywords)
+    search_future = None
+    
+    if need_search:
+        # 执行网络搜索
+        search_future = search_executor.submit(web_search, search_query)
+        search_deadline = time.monotonic() + SEARCH_JOIN_DEADLINE
+    
+    if scored_cases is None:
+        # 搜索进行的同时查找相关案例
+        scored_cases = find_relevant_cases(message, cases, with_scores=True, keywords=keywords)
+    relevant_cases = [case for case, score in scored_cases]
+    relevance_scores = [round(score, 4) for case, score in scored_cases]
+    
+    # 多轮对话只注入尚未引用过的案例
+    history = []
+    new_cases = scored_cases
+    if conversation is not None:
+        history = conversation_store.history_messages(conversation)
+        seen = conversation_store.case_ids(conversation)
+        new_cases = [(case, score) for case, score in scored_cases if case.get('id') not in seen]
+    history_tokens = sum(estimate_tokens(item['content']) for item in history)
+    
+    search_results = []
+    search_content = ""
+    
+    if need_search:
+        search_results = wait_for_search(search_future, search_deadline)
+        # 格式化搜索结果
+        search_content = format_search_results_for_ai(search_results, search_query)
+    
+    # 案例内容使用扣除固定提示、历史消息和搜索结果后的剩余预算
+    case_budget = max(
+        PROMPT_TOKEN_BUDGET - SYSTEM_PROMPT_STATIC_TOKENS - history_tokens - estimate_tokens(search_content),
+        CASE_CONTEXT_MIN_TOKENS
+    )
+    case_content = ""
+    truncated_cases = 0
+    if new_cases or conversation is None:
+        new_relevant = [case for case, score in new_cases]
+        passages = top_case_passages(new_relevant, keywords)
+        case_content, truncated_cases = pack_cases_for_ai(new_relevant, keywords, case_budget, passages)
+    case_tokens = estimate_tokens(case_content)
+    
+    if conversation is None:
+        # 单次对话：案例和搜索结果直接放进系统提示
+        system_prompt = build_system_prompt(case_content, search_content)
+        messages = [{"role": "system", "content": system_prompt}]
+        case_context = None
+    else:
+        system_prompt = SYSTEM_PROMPT_PREFIX
+        case_context = SYSTEM_PROMPT_CASES_HEADING + case_content if new_cases else None
+        messages = [{"role": "system", "content": system_prompt}]
+        messages.extend(history)
+        turn_context = "\n".join(part for part in (case_context, search_content) if part)
+        if turn_context:
+            messages.append({"role": "system", "content": turn_context})
+    messages.append({"role": "user", "content": message})
+    
+    prompt_chars = sum(len(item['content']) for item in messages) - len(message)
+    prompt_size = {
+        "chars": prompt_chars,
+        "estimated_tokens": sum(estimate_tokens(item['content']) for item in messages[:-1]),
+        "case_tokens": case_tokens,
+        "search_tokens": estimate_tokens(search_content),
+        "history_tokens": history_tokens,
+        "budget": PROMPT_TOKEN_BUDGET,
+        "truncated_cases": truncated_cases
+    }
+    
+    return {
+        "api_key": api_key,
+        "temperature": temperature,
+        "referenced_cases": relevant_cases,
+        "relevance_scores": relevance_scores,
+        "search_results": search_results if need_search else [],
+        "system_prompt": system_prompt,
+        "case_context": case_context,
+        "case_refs": [[case.get('id'), round(score, 4)] for case, score in new_cases] if case_context else [],
+        "messages": messages,
+        "follow_up": bool(conversation and (conversation['turns'] or conversation['summary'])),
+        "prompt_size": prompt_size
+    }
+
+# DeepSeek API地址（使用OpenAI兼容接口）
+DEEPSEEK_BASE_URL = "https://api.deepseek.com"
+
+# OpenAI客户端注册表：按 (api_key, base_url) 复用客户端及其keep-alive连接池
+_ai_clients = {}
+_ai_clients_lock = threading.Lock()
+
+# 获取复用的OpenAI客户端，API密钥变化时替换旧客户端
+# 旧客户端只从注册表移除而不主动关闭：进行中的流式或批量调用仍持有它，全部结束后由垃圾回收关闭连接池
+def get_ai_client(api_key, base_url=DEEPSEEK_BASE_URL):
+    key = (api_key, base_url)
+    with _ai_clients_lock:
+        client = _ai_clients.get(key)
+        if client is None:
+            for stale_key in [k for k in _ai_clients if k[1] == base_url]:
+                del _ai_clients[stale_key]
+            client = openai.OpenAI(api_key=api_key, base_url=base_url)
+            _ai_clients[key] = client
+        return client
+
+# 移除与当前API密钥不一致的客户端（设置更新时调用）
+def prune_ai_clients(api_key):
+    with _ai_clients_lock:
+        for stale_key in [k for k in _ai_clients if k[0] != api_key]:
+            del _ai_clients[stale_key]
+
+# 调用DeepSeek API（stream为True时返回增量片段的迭代器，最后一个片段带有用量统计）
+def create_chat_completion(message, context, stream=False):
+    client = get_ai_client(context['api_key'])
+    
+    options = {"stream_options": {"include_usage": True}} if stream else {}
+    return client.chat.completions.create(
+        model="deepseek-chat",
+        messages=context['messages'],
+        temperature=context['temperature'],
+        stream=stream,
+        **options
+    )
+
+# 提示词缓存统计：累计DeepSeek用量中命中/未命中上下文缓存的提示词token数
+_prompt_usage = {"requests": 0, "prompt_tokens": 0, "prompt_cache_hit_tokens": 0, "prompt_cache_miss_tokens": 0}
+_prompt_usage_lock = threading.Lock()
+
+# 记录一次调用的用量，返回本次的token统计（用量缺失时返回None）
+def record_prompt_usage(usage):
+    if usage is None:
+        return None
+    record = {
+        "prompt_tokens": getattr(usage, 'prompt_tokens', 0) or 0,
+        "completion_tokens": getattr(usage, 'completion_tokens', 0) or 0,
+        "prompt_cache_hit_tokens": getattr(usage, 'prompt_cache_hit_tokens', 0) or 0,
+        "prompt_cache_miss_tokens": getattr(usage, 'prompt_cache_miss_tokens', 0) or 0
+    }
+    with _prompt_usage_lock:
+        _prompt_usage['requests'] += 1
+        for key in ('prompt_tokens', 'prompt_cache_hit_tokens', 'prompt_cache_miss_tokens'):
+            _prompt_usage[key] += record[key]
+    return record
+
+def prompt_usage_stats():
+    with _prompt_usage_lock:
+        stats = dict(_prompt_usage)
+    stats['hit_rate'] = round(stats['prompt_cache_hit_tokens'] / stats['prompt_tokens'], 4) if stats['prompt_tokens'] else 0.0
+    return stats
+
+# 回答缓存设置：有效期（秒，0表示关闭）和最大条目数
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', '3600'))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', '500'))
+
+# 案例版本：案例内容的摘要，案例被编辑后版本随之变化
+def case_version(case):
+    return hashlib.sha1(json.dumps(case, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+# 重复咨询问题的回答缓存：键由规范化的问题、引用案例及其版本、温度和搜索结果指纹组成
+# 引用的案例被编辑或删除时，相关条目立即失效
+class ResponseCache:
+    def __init__(self, max_entries, ttl):
+        self.enabled = ttl > 0
+        self._cache = TTLCache(max_entries, ttl, on_evict=self._forget)
+        self._by_case = {}  # case_id -> {缓存键}，只包含仍在缓存中的键
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, message, context):
+        search_fingerprint = [(result.get('title'), result.get('link')) for result in context['search_results']]
+        raw = json.dumps([
+            normalize_search_query(message),
+            [(case.get('id'), case_version(case)) for case in context['referenced_cases']],
+            context['temperature'],
+            search_fingerprint
+        ], ensure_ascii=False)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        value = self._cache.get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, context, text):
+        if not self.enabled:
+            return
+        # 先登记反向索引再写入缓存，写入后立即被挤出的键也能由_forget清理
+        with self._lock:
+            for case in context['referenced_cases']:
+                self._by_case.setdefault(case.get('id'), set()).add(key)
+        self._cache.set(key, {
+            "text": text,
+            "referenced_cases": context['referenced_cases'],
+            "relevance_scores": context['relevance_scores'],
+            "search_results": context['search_results'],
+            "prompt_size": context['prompt_size']
+        })
+
+    # 缓存条目被删除后，从其引用的每个案例的反向索引中移除对应的键
+    def _forget(self, entries):
+        with self._lock:
+            for key, value in entries:
+                for case in value['referenced_cases']:
+                    keys = self._by_case.get(case.get('id'))
+                    if keys is None:
+                        continue
+                    keys.discard(key)
+                    if not keys:
+                        del self._by_case[case.get('id')]
+
+    def on_case_changed(self, case_id, case):
+        with self._lock:
+            keys = self._by_case.pop(case_id, ())
+        removed = []
+        for key in keys:
+            value = self._cache.pop(key)
+            if value is not None:
+                removed.append((key, value))
+        self._forget(removed)
+
+    def __len__(self):
+        return len(self._cache)
+
+    def stats(self):
+        return cache_stats(len(self), self.hits, self.misses)
+
+response_cache = ResponseCache(RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL)
+case_store.subscribe(response_cache.on_case_changed, replay=False)
+
+# 缓存命中统计
+def cache_stats(entries, hits, misses):
+    lookups = hits + misses
+    return {
+        "entries": entries,
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": round(hits / lookups, 4) if lookups else 0.0
+    }
+
+# 语义缓存设置：问题向量的余弦相似度阈值和最大条目数（0表示关闭）
+# 哈希向量下换种说法的问题相似度远低于阈值，语义缓存只会白白计算向量，所以只在设置了EMBEDDING_MODEL时默认开启
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get('SEMANTIC_CACHE_THRESHOLD', '0.9'))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.environ.get('SEMANTIC_CACHE_MAX_ENTRIES', '200' if EMBEDDING_MODEL else '0'))
+
+# 语义回答缓存：问题向量按行存入固定容量的矩阵，查找时一次矩阵乘法算出与所有缓存问题的相似度
+# 只有检索到的案例集合（含版本）和温度都一致时才返回缓存的回答；容量满时覆盖最早的条目
+class SemanticCache:
+    def __init__(self, embedder, max_entries, threshold, ttl):
+        self.embedder = embedder
+        self.threshold = threshold
+        self.ttl = ttl
+        self._matrix = np.zeros((max_entries, embedder.dim), dtype=np.float32)
+        self._entries = [None] * max_entries  # 行号 -> (案例集合键, 过期时间, 回答)
+        self._by_case = {}  # case_id -> {行号}
+        self._next = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _case_key(context):
+        return (
+            tuple((case.get('id'), case_version(case)) for case in context['referenced_cases']),
+            context['temperature']
+        )
+
+    # 返回 (缓存的回答, 问题向量)，未命中时回答为None，问题向量可直接用于写入
+    def lookup(self, message, context):
+        vector = self.embedder.embed([normalize_search_query(message)])[0]
+        case_key = self._case_key(context)
+        now = time.time()
+        with self._lock:
+            similarities = self._matrix @ vector
+            candidates = np.flatnonzero(similarities >= self.threshold)
+            for row in candidates[np.argsort(-similarities[candidates])]:
+                entry = self._entries[row]
+                if entry is not None and entry[0] == case_key and entry[1] > now:
+                    self.hits += 1
+                    return entry[2], vector
+            self.misses += 1
+        return None, vector
+
+    def set(self, vector, context, text):
+        value = {
+            "text": text,
+            "referenced_cases": context['referenced_cases'],
+            "relevance_scores": context['relevance_scores'],
+            "search_results": context['search_results'],
+            "prompt_size": context['prompt_size']
+        }
+        case_key = self._case_key(context)
+        with self._lock:
+            row = self._next
+            self._clear_row(row)
+            self._matrix[row] = vector
+            self._entries[row] = (case_key, time.time() + self.ttl, value)
+            for case_id, _ in case_key[0]:
+                self._by_case.setdefault(case_id, set()).add(row)
+            self._next = (row + 1) % len(self._entries)
+
+    # 清空一行并从其引用的各案例的行号集合中移除（调用方持有锁）
+    def _clear_row(self, row):
+        entry = self._entries[row]
+        if entry is None:
+            return
+        for case_id, _ in entry[0][0]:
+            rows = self._by_case.get(case_id)
+            if rows is not None:
+                rows.discard(row)
+                if not rows:
+                    del self._by_case[case_id]
+        self._entries[row] = None
+        self._matrix[row] = 0
+
+    def on_case_changed(self, case_id, case):
+        with self._lock:
+            for row in list(self._by_case.get(case_id, ())):
+                self._clear_row(row)
+
+    def __len__(self):
+        with self._lock:
+            return sum(entry is not None for entry in self._entries)
+
+    def stats(self):
+        return dict(cache_stats(len(self), self.hits, self.misses), threshold=self.threshold)
+
+semantic_cache = None
+if SEMANTIC_CACHE_MAX_ENTRIES > 0 and RESPONSE_CACHE_TTL > 0 and np is not None:
+    semantic_cache = SemanticCache(
+        case_vectors.embedder if case_vectors is not None else create_embedder(),
+        SEMANTIC_CACHE_MAX_ENTRIES, SEMANTIC_CACHE_THRESHOLD, RESPONSE_CACHE_TTL
+    )
+    case_store.subscribe(semantic_cache.on_case_changed, replay=False)
+
+# 依次查找精确缓存和语义缓存，返回 (缓存的回答, 缓存键, 问题向量)
+# 多轮对话的后续轮次依赖历史消息，不使用缓存
+def lookup_cached_answer(message, context):
+    if context['follow_up']:
+        return None, None, None
+    cache_key = response_cache.key(message, context)
+    cached = response_cache.get(cache_key)
+    query_vector = None
+    if cached is None and semantic_cache is not None:
+        cached, query_vector = semantic_cache.lookup(message, context)
+    return cached, cache_key, query_vector
+
+# 将新的回答写入精确缓存和语义缓存
+def store_cached_answer(cache_key, query_vector, context, text):
+    if cache_key is None:
+        return
+    response_cache.set(cache_key, context, text)
+    if query_vector is not None:
+        semantic_cache.set(query_vector, context, text)
+
+# 将一轮问答写入多轮对话，写入失败不影响本次回答
+def record_conversation_turn(conversation, message, text, context):
+    if conversation is None:
+        return
+    try:
+        conversation_store.record_turn(conversation, message, text, context)
+    except Exception as e:
+        print(f"保存对话 {conversation['id']} 时出错: {str(e)}")
 
 # 使用DeepSeek API进行对话，并结合案例库分析和网络搜索
-def get_ai_response(message, cases, settings):
+def get_ai_response(message, cases=None, settings=None, conversation=None):
+    settings = settings or settings_service.get()
     try:
-        # 获取API设置
-        api_key = settings.get('ai', {}).get('api_key', '')
-        temperature = float(settings.get('ai', {}).get('temperature', 0.7))
-        
         # 如果没有API密钥，返回模拟响应
-        if not api_key:
+        if not settings.api_key:
             return simulate_ai_response(message, cases)
         
-        # 查找相关案例
-        relevant_cases = find_relevant_cases(message, cases)
-        
-        # 格式化案例内容
-        case_content = format_cases_for_ai(relevant_cases)
-        
-        # 判断是否需要网络搜索
-        need_search = should_perform_web_search(message)
-        search_results = []
-        search_content = ""
-        
-        if need_search:
-            # 提取搜索关键词
-            search_query = extract_search_query(message)
-            # 执行网络搜索
-            search_results = web_search(search_query)
-            # 格式化搜索结果
-            search_content = format_search_results_for_ai(search_results, search_query)
-        
-        # 初始化OpenAI客户端（DeepSeek使用OpenAI兼容接口）
-        client = openai.OpenAI(
-            api_key=api_key,
-            base_url="https://api.deepseek.com"
-        )
-        
-        # 准备系统提示和用户消息
-        system_prompt = f"""你是写春秋企业管理咨询的AI助手，专注于为企业提供专业的管理咨询建议。
-        你可以访问并分析公司的案例库，为用户提供基于实际案例的专业建议。
-        你还具备深度思考能力，可以进行多步骤推理和全面分析，并能通过网络搜索获取最新信息。
+        context = prepare_ai_context(message, cases, settings, conversation)
         
-        在回答用户问题时，请遵循以下原则：
-        1. 分析用户问题，提取关键需求和管理主题
-        2. 参考相关案例库内容，提供有针对性的建议
-        3. 引用案例中的具体经验和数据支持你的建议
-        4. 进行深度思考，从多个角度分析问题
-        5. 当需要最新信息时，参考网络搜索结果
-        6. 提供结构化的分析框架和实施步骤
-        7. 保持专业、严谨的咨询顾问语气
-        
-        案例库内容：
-        {case_content}
-        
-        {search_content if need_search else ""}
-        
-        如果用户询问特定行业或管理问题，请基于上述案例和搜索结果提供详细分析。如果案例库中没有完全匹配的案例，可以基于管理理论和最佳实践提供建议，但要明确说明这是基于理论而非具体案例。
-        
-        在回答时，请采用以下结构：
-        1. 问题分析：简要概述用户问题的核心需求和关键点
-        2. 案例参考：引用相关案例中的经验和数据
-        3. 深度思考：从多个角度分析问题，考虑不同因素和可能的影响
-        4. 行业洞察：结合最新行业趋势和数据（如有网络搜索结果）
-        5. 建议方案：提供具体、可操作的解决方案和实施步骤
-        6. 预期效果：分析方案可能带来的效果和潜在风险
-        """
+        # 相同或相近的问题、相同的案例直接返回缓存的回答
+        cached, cache_key, query_vector = lookup_cached_answer(message, context)
+        if cached is not None:
+            record_conversation_turn(conversation, message, cached['text'], context)
+            return dict(cached, cached=True)
         
         # 调用DeepSeek API
-        response = client.chat.completions.create(
-            model="deepseek-chat",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": message}
-            ],
-            temperature=temperature,
-            stream=False
-        )
+        response = create_chat_completion(message, context)
+        text = response.choices[0].message.content
+        usage = record_prompt_usage(getattr(response, 'usage', None))
+        store_cached_answer(cache_key, query_vector, context, text)
+        record_conversation_turn(conversation, message, text, context)
         
         # 返回结果
         return {
-            "text": response.choices[0].message.content,
-            "referenced_cases": relevant_cases,
-            "search_results": search_results if need_search else []
+            "text": text,
+            "referenced_cases": context['referenced_cases'],
+            "relevance_scores": context['relevance_scores'],
+            "search_results": context['search_results'],
+            "prompt_size": context['prompt_size'],
+            "usage": usage
         }
     except Exception as e:
         print(f"AI API调用错误: {str(e)}")
         # 出错时返回模拟响应
         return simulate_ai_response(message, cases)
 
-# 判断是否应该执行网络搜索
-def should_perform_web_search(message):
-    # 检查是否包含需要最新信息的关键词
-    search_indicators = [
-        "最新", "趋势", "现状", "数据", "统计", "报告", "研究", "调查",
-        "市场", "行业", "发展", "前景", "预测", "政策", "法规",
-        "新闻", "近期", "最近", "今年", "未来"
-    ]
+# 格式化一条Server-Sent Events消息
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+# 流式对话：先推送引用案例和搜索结果，再逐段转发模型输出
+def stream_ai_response(message, cases=None, settings=None, conversation=None):
+    settings = settings or settings_service.get()
+    context = None
+    try:
+        if settings.api_key:
+            context = prepare_ai_context(message, cases, settings, conversation)
+    except Exception as e:
+        print(f"AI API调用错误: {str(e)}")
+    conversation_id = conversation['id'] if conversation else None
     
-    for indicator in search_indicators:
-        if indicator in message:
-            return True
+    # 没有API密钥或准备上下文失败时，整段推送模拟响应
+    if context is None:
+        response = simulate_ai_response(message, cases)
+        yield sse_event('context', {
+            "referenced_cases": response['referenced_cases'],
+            "relevance_scores": response['relevance_scores'],
+            "search_results": response['search_results'],
+            "conversation_id": conversation_id
+        })
+        yield sse_event('delta', {"text": response['text']})
+        yield sse_event('done', {})
+        return
     
-    # 检查是否是明确的搜索请求
-    search_requests = [
-        "搜索", "查询", "查找", "了解", "获取信息", "查一下",
-        "网上", "互联网", "资料", "信息", "查询一下"
-    ]
+    yield sse_event('context', {
+        "referenced_cases": context['referenced_cases'],
+        "relevance_scores": context['relevance_scores'],
+        "search_results": context['search_results'],
+        "prompt_size": context['prompt_size'],
+        "conversation_id": conversation_id
+    })
     
-    for request in search_requests:
-        if request in message:
-            return True
+    # 命中回答缓存时整段推送
+    cached, cache_key, query_vector = lookup_cached_answer(message, context)
+    if cached is not None:
+        record_conversation_turn(conversation, message, cached['text'], context)
+        yield sse_event('delta', {"text": cached['text'], "cached": True})
+        yield sse_event('done', {})
+        return
     
-    return False
+    sent_text = []
+    usage = None
+    try:
+        for chunk in create_chat_completion(message, context, stream=True):
+            if getattr(chunk, 'usage', None) is not None:
+                usage = record_prompt_usage(chunk.usage)
+            if not chunk.choices:
+                continue
+            text = chunk.choices[0].delta.content
+            if text:
+                sent_text.append(text)
+                yield sse_event('delta', {"text": text})
+        if sent_text:
+            store_cached_answer(cache_key, query_vector, context, "".join(sent_text))
+            record_conversation_turn(conversation, message, "".join(sent_text), context)
+    except Exception as e:
+        print(f"AI API调用错误: {str(e)}")
+        if not sent_text:
+            # 尚未输出内容时退回模拟响应
+            yield sse_event('delta', {"text": simulate_ai_response(message, cases)['text']})
+        else:
+            yield sse_event('error', {"error": "AI响应中断，请稍后再试。"})
+    
+    yield sse_event('done', {"usage": usage})
+
+# 批量咨询设置：单次最多的问题数、同时进行的模型调用数，以及遇到限流时的重试次数和初始退避时间（秒）
+BATCH_MAX_MESSAGES = int(os.environ.get('BATCH_MAX_MESSAGES', '500'))
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', '4'))
+BATCH_MAX_RETRIES = 5
+BATCH_RETRY_BACKOFF = 1.0
+BATCH_RETRY_MAX_DELAY = 30.0
+
+# 调用模型，遇到限流（429）时按Retry-After或指数退避加随机抖动重试
+def create_chat_completion_with_backoff(message, context):
+    for attempt in range(BATCH_MAX_RETRIES + 1):
+        try:
+            return create_chat_completion(message, context)
+        except openai.RateLimitError as e:
+            if attempt == BATCH_MAX_RETRIES:
+                raise
+            delay = BATCH_RETRY_BACKOFF * (2 ** attempt)
+            retry_after = e.response.headers.get('retry-after') if e.response is not None else None
+            try:
+                delay = max(delay, float(retry_after))
+            except (TypeError, ValueError):
+                pass
+            time.sleep(min(delay, BATCH_RETRY_MAX_DELAY) * (0.5 + secrets.randbelow(1000) / 1000))
+
+# 回答批量咨询中的一个问题，返回一行结果；出错时返回错误信息而不退回模拟响应
+def answer_batch_message(index, message, settings, scored_cases):
+    try:
+        if not settings.api_key:
+            response = simulate_ai_response(message)
+            cached = False
+            usage = None
+        else:
+            context = prepare_ai_context(message, settings=settings, scored_cases=scored_cases)
+            response, cache_key, query_vector = lookup_cached_answer(message, context)
+            cached = response is not None
+            usage = None
+            if not cached:
+                completion = create_chat_completion_with_backoff(message, context)
+                text = completion.choices[0].message.content
+                usage = record_prompt_usage(getattr(completion, 'usage', None))
+                store_cached_answer(cache_key, query_vector, context, text)
+                response = {
+                    "text": text,
+                    "referenced_cases": context['referenced_cases'],
+                    "search_results": context['search_results']
+                }
+        return {
+            "index": index,
+            "message": message,
+            "text": response['text'],
+            "referenced_cases": [
+                {"id": case.get('id'), "title": case.get('title')} for case in response['referenced_cases']
+            ],
+            "search_results": response['search_results'],
+            "cached": cached,
+            "usage": usage
+        }
+    except Exception as e:
+        print(f"批量咨询第 {index} 个问题出错: {str(e)}")
+        return {"index": index, "message": message, "error": str(e)}
+
+# 批量咨询：先在同一份案例库快照上为所有问题检索案例，再按BATCH_CONCURRENCY并发调用模型，按完成顺序逐行输出NDJSON
+def stream_batch_responses(messages, settings):
+    retrieved = [None] * len(messages)
+    if settings.api_key:
+        with case_store.snapshot():
+            retrieved = [find_relevant_cases(message, with_scores=True) for message in messages]
+    executor = ThreadPoolExecutor(max_workers=BATCH_CONCURRENCY, thread_name_prefix='batch-chat')
+    try:
+        futures = [
+            executor.submit(answer_batch_message, index, message, settings, retrieved[index])
+            for index, message in enumerate(messages)
+        ]
+        failed = 0
+        for future in as_completed(futures):
+            result = future.result()
+            failed += 'error' in result
+            yield json.dumps(result, ensure_ascii=False) + "\n"
+        yield json.dumps({"done": True, "total": len(messages), "failed": failed}) + "\n"
+    finally:
+        # 客户端断开时取消尚未开始的问题
+        executor.shutdown(wait=False, cancel_futures=True)
 
-# 从用户消息中提取搜索查询
-def extract_search_query(message):
+# 需要最新信息的关键词
+SEARCH_INDICATORS = [
+    "最新", "趋势", "现状", "数据", "统计", "报告", "研究", "调查",
+    "市场", "行业", "发展", "前景", "预测", "政策", "法规",
+    "新闻", "近期", "最近", "今年", "未来"
+]
+
+# 明确的搜索请求
+SEARCH_REQUESTS = [
+    "搜索", "查询", "查找", "了解", "获取信息", "查一下",
+    "网上", "互联网", "资料", "信息", "查询一下"
+]
+
+# 搜索请求前缀（按顺序匹配第一个）
+SEARCH_PREFIXES = [
+    "请搜索", "帮我搜索", "查询", "查找", "了解", "获取信息关于",
+    "查一下", "搜一下", "查询一下", "我想知道关于", "告诉我关于"
+]
+
+# 已包含企业管理语境的查询词
+SEARCH_CONTEXT_TERMS = ["企业", "管理", "咨询", "商业", "战略"]
+
+# 预编译的搜索意图匹配：一次扫描判断是否包含任一搜索指示词
+_SEARCH_INTENT_RE = re.compile('|'.join(re.escape(w) for w in SEARCH_INDICATORS + SEARCH_REQUESTS))
+_SEARCH_PREFIX_RE = re.compile('|'.join(re.escape(p) for p in SEARCH_PREFIXES))
+_SEARCH_CONTEXT_RE = re.compile('|'.join(re.escape(t) for t in SEARCH_CONTEXT_TERMS))
+
+# 搜索意图分类：返回 (是否需要搜索, 搜索查询)，不需要搜索时查询为None
+# keywords为检索案例时已提取的关键词，长消息直接复用，不再重复提取
+def classify_search_intent(message, keywords=None):
+    if not _SEARCH_INTENT_RE.search(message):
+        return False, None
+    return True, build_search_query(message, keywords)
+
+# 由用户消息构建搜索查询
+def build_search_query(message, keywords=None):
     # 移除常见的搜索请求词
-    search_prefixes = [
-        "请搜索", "帮我搜索", "查询", "查找", "了解", "获取信息关于",
-        "查一下", "搜一下", "查询一下", "我想知道关于", "告诉我关于"
-    ]
-    
     query = message
-    for prefix in search_prefixes:
-        if message.startswith(prefix):
-            query = message[len(prefix):].strip()
-            break
+    prefix = _SEARCH_PREFIX_RE.match(message)
+    if prefix:
+        query = message[prefix.end():].strip()
     
     # 如果消息太长，提取关键部分作为搜索查询
     if len(query) > 100:
-        # 提取关键词
-        keywords = extract_keywords(message)
-        if keywords:
-            query = " ".join(keywords)
+        if keywords is None:
+            keywords = extract_keywords(message)
+        query = " ".join(keywords)
     
     # 添加"企业管理咨询"相关上下文，使搜索结果更相关
-    if not any(term in query for term in ["企业", "管理", "咨询", "商业", "战略"]):
+    if not _SEARCH_CONTEXT_RE.search(query):
         query += " 企业管理"
     
     return query
 
 # 模拟AI对话（作为备用）
-def simulate_ai_response(message, cases):
+def simulate_ai_response(message, cases=None):
     # 模拟AI思考时间
     time.sleep(1.5)
     
     # 查找相关案例
-    relevant_cases = find_relevant_cases(message, cases)
+    scored_cases = find_relevant_cases(message, cases, with_scores=True)
+    relevant_cases = [case for case, score in scored_cases]
+    relevance_scores = [round(score, 4) for case, score in scored_cases]
     
     # 根据用户输入生成相关回复
     if "战略" in message:
         return {
             "text": "基于您提到的战略问题，我建议从以下几个方面考虑：\n\n1. 明确企业核心竞争力\n2. 分析行业发展趋势\n3. 评估市场机会与威胁\n4. 制定差异化战略\n\n我们有多个类似案例可供参考，特别是在制造业数字化转型方面的成功经验。",
             "referenced_cases": relevant_cases,
+            "relevance_scores": relevance_scores,
             "search_results": []
         }
     elif "组织" in message or "架构" in message:
         return {
             "text": "关于组织架构优化，建议考虑：\n\n1. 业务流程与组织结构匹配度\n2. 决策链条长度与效率\n3. 跨部门协作机制\n4. 绩效考核与激励机制\n\n根据我们的经验，扁平化管理结构通常能提高中型企业的运营效率。",
             "referenced_cases": relevant_cases,
+            "relevance_scores": relevance_scores,
             "search_results": []
         }
     elif "人才" in message or "招聘" in message:
         return {
             "text": "人才管理是企业发展的关键因素。建议从以下方面着手：\n\n1. 建立完善的人才招聘体系\n2. 设计有竞争力的薪酬结构\n3. 提供清晰的职业发展路径\n4. 营造积极的企业文化\n\n我们曾帮助多家企业解决人才流失问题，提高员工满意度和生产力。",
             "referenced_cases": relevant_cases,
+            "relevance_scores": relevance_scores,
             "search_results": []
         }
     else:
         return {
             "text": "感谢您的咨询。作为写春秋企业管理咨询的AI助手，我可以帮助您解决企业管理中的各类问题，包括战略规划、组织变革、流程优化、数字化转型和人才管理等。请详细描述您的具体需求，我将结合我们的案例库为您提供专业建议。",
             "referenced_cases": relevant_cases,
+            "relevance_scores": relevance_scores,
             "search_results": []
         }
 
@@ -522,76 +3086,71 @@ def static_files(path):
 @password_required
 def handle_settings():
     if request.method == 'GET':
-        with open(SETTINGS_FILE, 'r') as f:
-            return jsonify(json.load(f))
+        return jsonify(settings_service.get().raw)
     else:  # PUT
-        settings = request.json
-        with open(SETTINGS_FILE, 'w') as f:
-            json.dump(settings, f)
+        try:
+            settings = settings_service.update(request.json)
+        except SettingsError as e:
+            return jsonify({"error": str(e)}), 400
+        # API密钥变化时释放旧的客户端连接池
+        prune_ai_clients(settings.api_key)
         return jsonify({"status": "success"})
 
 @app.route('/api/tags', methods=['GET', 'POST', 'PUT', 'DELETE'])
 @password_required
 def handle_tags():
     if request.method == 'GET':
-        with open(TAGS_FILE, 'r') as f:
-            return jsonify(json.load(f))
+        return jsonify(tags_document.read())
     elif request.method == 'POST':
         tag_data = request.json
-        with open(TAGS_FILE, 'r') as f:
-            tags = json.load(f)
-        
-        category = tag_data.get('category', '其他')
-        tag_name = tag_data.get('name')
-        
-        if category not in tags['categories']:
-            tags['categories'][category] = []
         
-        if tag_name not in tags['categories'][category]:
-            tags['categories'][category].append(tag_name)
+        def add_tag(tags):
+            category = tag_data.get('category', '其他')
+            tag_name = tag_data.get('name')
+            
+            if category not in tags['categories']:
+                tags['categories'][category] = []
+            
+            if tag_name not in tags['categories'][category]:
+                tags['categories'][category].append(tag_name)
         
-        with open(TAGS_FILE, 'w') as f:
-            json.dump(tags, f)
+        tags = tags_document.update(add_tag)
         
         return jsonify({"status": "success", "tags": tags})
     elif request.method == 'PUT':
         tag_data = request.json
-        with open(TAGS_FILE, 'r') as f:
-            tags = json.load(f)
-        
-        old_category = tag_data.get('old_category')
-        old_name = tag_data.get('old_name')
-        new_category = tag_data.get('new_category', old_category)
-        new_name = tag_data.get('new_name')
-        
-        # 删除旧标签
-        if old_category in tags['categories'] and old_name in tags['categories'][old_category]:
-            tags['categories'][old_category].remove(old_name)
         
-        # 添加新标签
-        if new_category not in tags['categories']:
-            tags['categories'][new_category] = []
-        
-        if new_name not in tags['categories'][new_category]:
-            tags['categories'][new_category].append(new_name)
+        def rename_tag(tags):
+            old_category = tag_data.get('old_category')
+            old_name = tag_data.get('old_name')
+            new_category = tag_data.get('new_category', old_category)
+            new_name = tag_data.get('new_name')
+            
+            # 删除旧标签
+            if old_category in tags['categories'] and old_name in tags['categories'][old_category]:
+                tags['categories'][old_category].remove(old_name)
+            
+            # 添加新标签
+            if new_category not in tags['categories']:
+                tags['categories'][new_category] = []
+            
+            if new_name not in tags['categories'][new_category]:
+                tags['categories'][new_category].append(new_name)
         
-        with open(TAGS_FILE, 'w') as f:
-            json.dump(tags, f)
+        tags = tags_document.update(rename_tag)
         
         return jsonify({"status": "success", "tags": tags})
     else:  # DELETE
         tag_data = request.json
-        with open(TAGS_FILE, 'r') as f:
-            tags = json.load(f)
-        
-        category = tag_data.get('category')
-        name = tag_data.get('name')
         
-        if category in tags['categories'] and name in tags['categories'][category]:
-            tags['categories'][category].remove(name)
+        def delete_tag(tags):
+            category = tag_data.get('category')
+            name = tag_data.get('name')
+            
+            if category in tags['categories'] and name in tags['categories'][category]:
+                tags['categories'][category].remove(name)
         
-        with open(TAGS_FILE, 'w') as f:
-            json.dump(tags, f)
+        tags = tags_document.update(delete_tag)
         
         return jsonify({"status": "success", "tags": tags})
 
@@ -599,46 +3158,71 @@ def handle_tags():
 @password_required
 def handle_cases():
     if request.method == 'GET':
-        cases = []
-        for filename in os.listdir(CASES_DIR):
-            if filename.endswith('.json'):
-                with open(os.path.join(CASES_DIR, filename), 'r') as f:
-                    case = json.load(f)
-                    cases.append(case)
-        return jsonify(cases)
+        # 不带查询参数时保持原有行为，返回完整案例数组
+        if not request.args:
+            return jsonify(case_store.all())
+        
+        # 分页、筛选和字段投影：返回 {"cases": [...], "next_cursor": ..., "total": ...}
+        try:
+            try:
+                limit = int(request.args.get('limit', CASE_PAGE_SIZE))
+            except ValueError:
+                limit = 0
+            if limit < 1:
+                raise ValueError("limit必须是正整数")
+            limit = min(limit, CASE_PAGE_MAX)
+            cursor = request.args.get('cursor')
+            after = decode_case_cursor(cursor) if cursor else None
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        cases, next_key, total = case_store.list_cases(
+            tag=request.args.get('tag') or None,
+            query=request.args.get('q') or None,
+            created_from=request.args.get('created_from') or None,
+            created_to=request.args.get('created_to') or None,
+            after=after,
+            limit=limit
+        )
+        
+        fields = [f.strip() for f in request.args.get('fields', '').split(',') if f.strip()]
+        if fields:
+            fields = set(fields) | {'id'}
+            cases = [{k: v for k, v in case.items() if k in fields} for case in cases]
+        
+        return jsonify({
+            "cases": cases,
+            "next_cursor": encode_case_cursor(next_key) if next_key else None,
+            "total": total
+        })
     else:  # POST
         case_data = request.json
         case_id = str(uuid.uuid4())
         case_data['id'] = case_id
         case_data['created_at'] = time.strftime('%Y-%m-%d %H:%M:%S')
         
-        with open(os.path.join(CASES_DIR, f"{case_id}.json"), 'w') as f:
-            json.dump(case_data, f)
+        case_store.save(case_id, case_data)
         
         return jsonify({"status": "success", "case": case_data})
 
 @app.route('/api/cases/<case_id>', methods=['GET', 'PUT', 'DELETE'])
 @password_required
 def handle_case(case_id):
-    case_file = os.path.join(CASES_DIR, f"{case_id}.json")
-    
     if request.method == 'GET':
-        if os.path.exists(case_file):
-            with open(case_file, 'r') as f:
-                return jsonify(json.load(f))
+        case = case_store.get(case_id)
+        if case is not None:
+            return jsonify(case)
         else:
             return jsonify({"error": "Case not found"}), 404
     elif request.method == 'PUT':
         case_data = request.json
         case_data['updated_at'] = time.strftime('%Y-%m-%d %H:%M:%S')
         
-        with open(case_file, 'w') as f:
-            json.dump(case_data, f)
+        case_store.save(case_id, case_data)
         
         return jsonify({"status": "success", "case": case_data})
     else:  # DELETE
-        if os.path.exists(case_file):
-            os.remove(case_file)
+        if case_store.delete(case_id):
             return jsonify({"status": "success"})
         else:
             return jsonify({"error": "Case not found"}), 404
@@ -647,19 +3231,62 @@ def handle_case(case_id):
 @password_required
 def handle_chat():
     message = request.json.get('message', '')
+    stream = bool(request.json.get('stream', False))
     
-    # 获取所有案例数据
-    cases = load_all_cases()
+    # 请求中带有conversation_id字段时按多轮对话处理（值为空时新建对话）
+    conversation = None
+    if 'conversation_id' in request.json:
+        conversation = conversation_store.get_or_create(request.json.get('conversation_id'))
     
-    # 获取设置
-    with open(SETTINGS_FILE, 'r') as f:
-        settings = json.load(f)
+    # 获取设置（内存中的设置对象，不读取文件）
+    settings = settings_service.get()
     
-    # 调用AI响应
-    response = get_ai_response(message, cases, settings)
+    # 流式响应：以SSE逐段返回模型输出
+    if stream:
+        return Response(
+            stream_with_context(stream_ai_response(message, settings=settings, conversation=conversation)),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
+    
+    # 调用AI响应（案例检索走案例库索引）
+    response = get_ai_response(message, settings=settings, conversation=conversation)
+    if conversation is not None:
+        response['conversation_id'] = conversation['id']
     
     return jsonify(response)
 
+# 批量咨询：请求体为 {"messages": [问题, ...]}，以NDJSON逐行返回每个问题的结果
+@app.route('/api/chat/batch', methods=['POST'])
+@password_required
+def handle_chat_batch():
+    messages = (request.json or {}).get('messages')
+    if not isinstance(messages, list) or not messages:
+        return jsonify({"error": "messages必须是非空的问题列表"}), 400
+    if len(messages) > BATCH_MAX_MESSAGES:
+        return jsonify({"error": f"单次最多提交{BATCH_MAX_MESSAGES}个问题"}), 400
+    if not all(isinstance(message, str) and message.strip() for message in messages):
+        return jsonify({"error": "每个问题必须是非空字符串"}), 400
+    
+    # 整个批次只读取一次设置
+    settings = settings_service.get()
+    
+    return Response(
+        stream_with_context(stream_batch_responses(messages, settings)),
+        mimetype='application/x-ndjson',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+# 回答缓存命中统计和DeepSeek提示词缓存命中统计
+@app.route('/api/cache/stats', methods=['GET'])
+@password_required
+def get_cache_stats():
+    return jsonify({
+        "response_cache": response_cache.stats(),
+        "semantic_cache": semantic_cache.stats() if semantic_cache is not None else None,
+        "prompt_cache": prompt_usage_stats()
+    })
+
 # 健康检查端点
 @app.route('/health')
 def health_check():
@@ -693,11 +3320,15 @@ def add_sample_cases():
         case['id'] = case_id
         case['created_at'] = time.strftime('%Y-%m-%d %H:%M:%S')
         
-        with open(os.path.join(CASES_DIR, f"{case_id}.json"), 'w') as f:
-            json.dump(case, f)
+        case_store.save(case_id, case)
+
+# 启动时一次性加载案例库
+case_store.refresh(force=True)
+if case_vectors is not None:
+    case_vectors.drop_unreported()
 
-# 启动时添加示例案例
-if len(os.listdir(CASES_DIR)) == 0:
+# 案例库为空时添加示例案例
+if case_store.count() == 0:
     add_sample_cases()
 
 if __name__ == '__main__':
@@ -0,0 +1,101 @@
+# 案例相关性计分基准测试
+# 对比原有的逐案例循环计分（calculate_relevance_score + 全量排序）
+# 与词项-案例得分矩阵（CaseTermMatrix：矩阵-向量乘法 + argpartition部分选择）
+#
+# 用法：python benchmarks/bench_relevance_scoring.py [案例数 ...]
+# 默认分别测试1千、1万和10万个生成的案例；“首次查询”是词表外关键词计算得分行的那次查询
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+
+FILLER = "企业在发展过程中面临市场竞争加剧和成本上升等挑战，需要系统梳理业务流程并提升管理效率。"
+# 词表内的问题：关键词全部来自预定义关键词，只走矩阵乘法
+MESSAGES = [
+    "制造业数字化转型怎么做",
+    "中型企业的人才管理和绩效管理",
+    "零售业供应链优化与成本控制",
+]
+# 词表外的问题：关键词来自兜底分词，首次查询计算得分行，之后命中缓存行
+OOV_MESSAGES = [
+    "我们公司的门店客流下滑，应该怎样调整经营思路",
+    "老板想知道业务流程梳理从哪里入手",
+]
+
+
+def build_cases(count, rng):
+    cases = []
+    for i in range(count):
+        words = rng.sample(app.BUILTIN_KEYWORDS, 4)
+        cases.append({
+            'id': f'bench-{i}',
+            'title': f"某{words[0]}企业{words[1]}项目",
+            'description': f"帮助客户推进{words[2]}，提升整体运营水平。",
+            'content': FILLER * 4 + f"项目重点包括{words[1]}和{words[3]}。",
+            'tags': words[:2],
+        })
+    return cases
+
+
+# 原有实现：逐案例计分后全量排序
+def loop_top(cases, keywords, max_cases=3):
+    scored_cases = [(case, app.calculate_relevance_score(case, keywords)) for case in cases]
+    scored_cases.sort(key=lambda x: x[1], reverse=True)
+    return scored_cases[:max_cases]
+
+
+def timed(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return (time.perf_counter() - start) / repeat * 1000, result
+
+
+def main():
+    if app.np is None:
+        print("需要安装numpy")
+        return
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1000, 10000, 100000]
+    rng = random.Random(42)
+
+    print(f"{'案例数':>8} {'问题':>6} {'候选来源':>8} {'矩阵构建':>10} {'循环计分':>10} {'首次查询':>10} {'矩阵计分':>10} {'加速':>6}")
+    for size in sizes:
+        cases = build_cases(size, rng)
+        index = app.CaseIndex()
+        for case in cases:
+            index.update(case['id'], case)
+
+        # 倒排索引：JSON后端的默认配置；文本扫描：SQLite后端（内存中没有倒排索引）
+        for source, candidate_index in (('倒排索引', index), ('文本扫描', None)):
+            start = time.perf_counter()
+            matrix = app.CaseTermMatrix(app.BUILTIN_KEYWORDS, candidate_index=candidate_index)
+            for case in cases:
+                matrix.update(case['id'], case)
+            build_ms = (time.perf_counter() - start) * 1000
+
+            repeat = max(1, 20000 // size)
+            for label, messages in (('词表内', MESSAGES), ('词表外', OOV_MESSAGES)):
+                loop_ms = matrix_ms = first_ms = 0.0
+                for message in messages:
+                    keywords = app.extract_keywords(message)
+                    assert label == '词表内' or any(k not in app.BUILTIN_KEYWORDS for k in keywords)
+                    elapsed, expected = timed(lambda: loop_top(cases, keywords), repeat)
+                    loop_ms += elapsed
+                    # 首次查询（词表外关键词需要计算得分行），之后为命中缓存行的查询
+                    elapsed, actual = timed(lambda: matrix.top(keywords, 3), 1)
+                    first_ms += elapsed
+                    assert [s for _, s in actual] == [s for _, s in expected if s > 0]
+                    elapsed, actual = timed(lambda: matrix.top(keywords, 3), repeat)
+                    matrix_ms += elapsed
+                    assert [s for _, s in actual] == [s for _, s in expected if s > 0]
+                loop_ms /= len(messages)
+                matrix_ms /= len(messages)
+                first_ms /= len(messages)
+                print(f"{size:>8} {label:>6} {source:>8} {build_ms:>8.0f}ms {loop_ms:>8.2f}ms "
+                      f"{first_ms:>8.2f}ms {matrix_ms:>8.2f}ms {loop_ms / matrix_ms:>5.0f}x")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+# 网络搜索结果解析基准测试
+# 对比原始的整页 html.parser 解析与 parse_search_results（片段截取 + SoupStrainer + 可选lxml）
+#
+# 用法：
+#   python benchmarks/bench_search_parse.py [保存的Bing结果页.html ...]
+# 不指定文件时使用 benchmarks/fixtures/ 下保存的结果页和生成的仿Bing页面（页头脚本/样式、10条结果和侧栏）
+# 每个页面先校验解析结果与整页解析完全一致，再计时
+import glob
+import os
+import sys
+import time
+
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+# 生成结构与Bing结果页相近的测试页面
+def build_sample_page(num_items=10):
+    head = "<head><title>数字化转型 企业管理 - 搜索</title>"
+    head += "<style>" + ".b_x{color:#000;margin:0;padding:0}" * 2000 + "</style>"
+    head += "<script>" + "var _w=window;_w._G={ST:(new Date)};" * 2000 + "</script></head>"
+    items = []
+    for i in range(num_items):
+        items.append(
+            f'<li class="b_algo" data-id="{i}"><div class="b_tpcn"><a class="tilk" href="https://example.com/{i}">'
+            f'<div class="tpic"><img src="data:image/png;base64,{"A" * 400}"></div></a></div>'
+            f'<div class="b_algoheader"><a href="https://example.com/article/{i}"><cite>example.com</cite></a>'
+            f'<h2><a href="https://example.com/article/{i}" h="ID=SERP,{i}">制造业数字化转型案例分析 第{i}篇</a></h2></div>'
+            f'<div class="b_caption"><div class="b_attribution"><cite>https://example.com/article/{i}</cite></div>'
+            f'<p class="b_lineclamp2">企业在数字化转型过程中需要从战略、组织、流程和技术四个维度系统推进，第{i}条摘要。</p></div></li>'
+        )
+    sidebar = '<ol id="b_context">' + '<li class="b_ans"><div>相关搜索</div></li>' * 30 + '</ol>'
+    body = f'<body><div id="b_header"></div><ol id="b_results">{"".join(items)}</ol>{sidebar}</body>'
+    return f"<!DOCTYPE html><html>{head}{body}</html>"
+
+
+# 原始实现：整页使用html.parser解析
+def parse_full_page(html, num_results=3):
+    soup = BeautifulSoup(html, 'html.parser')
+    results = []
+    for element in soup.select('.b_algo')[:num_results]:
+        title_element = element.select_one('h2 a')
+        if not title_element:
+            continue
+        snippet_element = element.select_one('.b_caption p')
+        results.append({
+            'title': title_element.get_text(),
+            'link': title_element.get('href', ''),
+            'snippet': snippet_element.get_text() if snippet_element else "无摘要"
+        })
+    return results
+
+
+def bench(label, fn, html, repeat):
+    fn(html)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(html)
+    elapsed = (time.perf_counter() - start) / repeat * 1000
+    print(f"  {label:<32} {elapsed:8.2f} ms")
+    return elapsed
+
+
+def main():
+    pages = []
+    for path in sys.argv[1:] or sorted(glob.glob(os.path.join(FIXTURES_DIR, '*.html'))):
+        with open(path, 'r', encoding='utf-8') as f:
+            pages.append((os.path.basename(path), f.read()))
+    if not sys.argv[1:]:
+        pages.append(('generated', build_sample_page()))
+
+    repeat = 50
+    for name, html in pages:
+        print(f"{name} ({len(html) // 1024} KB)")
+        for num_results in (1, 3, 10):
+            expected = parse_full_page(html, num_results)
+            assert expected, f"{name}: 整页解析没有结果"
+            assert app.parse_search_results(html, num_results, 'html.parser') == expected, f"{name}: {num_results}条结果不一致"
+            if app.SEARCH_HTML_PARSER == 'lxml':
+                assert app.parse_search_results(html, num_results, 'lxml') == expected, f"{name}: lxml {num_results}条结果不一致"
+        baseline = parse_full_page(html)
+        full = bench('full page, html.parser', parse_full_page, html, repeat)
+        fast = bench('sliced + strainer, html.parser',
+                     lambda h: app.parse_search_results(h, 3, 'html.parser'), html, repeat)
+        print(f"  speedup: {full / fast:.1f}x")
+        if app.SEARCH_HTML_PARSER == 'lxml':
+            assert app.parse_search_results(html, 3, 'lxml') == baseline
+            fast = bench('sliced + strainer, lxml',
+                         lambda h: app.parse_search_results(h, 3, 'lxml'), html, repeat)
+            print(f"  speedup: {full / fast:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
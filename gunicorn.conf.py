@@ -0,0 +1,23 @@
+# gunicorn配置
+# 对话请求大部分时间在等待DeepSeek和网络搜索，使用线程worker让这些等待
+# 不占满整个进程，其他请求（案例库、静态文件）可以并发处理
+import os
+
+# 线程worker：每个进程内多个线程并发处理请求，I/O等待时释放GIL
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_CONCURRENCY', '2'))
+threads = int(os.environ.get('GUNICORN_THREADS', '16'))
+
+# 流式对话和慢速模型调用可能持续一分钟以上
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '120'))
+graceful_timeout = 30
+keepalive = 5
+
+# 在主进程中加载应用：各worker共享同一个session密钥和已加载的案例库
+preload_app = True
+
+# 定期重启worker，避免长期运行后的内存增长
+max_requests = 1000
+max_requests_jitter = 100
+
+accesslog = '-'